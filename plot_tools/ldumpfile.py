@@ -0,0 +1,97 @@
+""" provides a header-only view of an ldump file which loads sample data on demand """
+import numpy as np
+
+import lwarchive
+import lwparse
+
+FCLK = 1300e6 / 7.0 * 11 / 20
+
+
+class LdumpFile(object):
+    """
+    Represents an ldump capture on disk. Only the header block is read when the
+    object is created, so metadata and axes are cheap to get for whole directories.
+    Sample data is parsed (or memory mapped from the cache) the first time data()
+    is called.
+
+    Parameters
+    ----------
+    filename : str
+        ldump file to read
+
+    avrfac : int, optional
+        moving average window passed to lwparse.parse
+
+    cache : bool, optional
+        whether lwparse.parse may use and write the binary cache sidecar
+
+    dtype : np.dtype, optional
+        precision of the parsed data, np.float32 for half the memory (see
+        lwparse.LdumpData)
+
+    Returns
+    -------
+    LdumpFile object
+    """
+    def __init__(self, filename, avrfac=512, cache=True, dtype=lwparse.DTYPE):
+        self.filename = filename
+        self.avrfac = avrfac
+        self.cache = cache
+        self.dtype = dtype
+        self.wave_samp_per, self.yscale = lwparse.read_header(filename)
+        self._rows = None
+        self._data = None
+
+    @property
+    def tsamp(self):
+        """ adc sample period (s) """
+        return 1 / FCLK
+
+    @property
+    def twave(self):
+        """ time between rows (s) """
+        return (self.wave_samp_per / FCLK) * 22 * 2
+
+    @property
+    def rows(self):
+        """ number of data rows, counted without parsing the file """
+        if self._rows is None:
+            if self._data is not None:
+                self._rows = self._data.columns.shape[0]
+            else:
+                self._rows = lwparse.count_rows(self.filename)
+        return self._rows
+
+    @property
+    def fwave(self):
+        """ frequency resolution of a full length fft (Hz) """
+        return 1.0 / self.twave / self.rows
+
+    def taxis(self):
+        """ returns the time of each row (s) """
+        return np.arange(self.rows) * self.twave
+
+    def faxis(self):
+        """ returns the frequency of each full length fft bin (Hz) """
+        return np.arange(self.rows) * self.fwave
+
+    def read_rows(self, start, stop):
+        """
+        returns raw (n, 8) columns of rows start to stop. archives decompress only
+        the chunks holding those rows, text files are parsed (or cached) in full
+        """
+        if lwarchive.is_archive(self.filename):
+            return lwarchive.Archive(self.filename).read(start, stop)
+        return self.data().columns[start:stop]
+
+    def read_time(self, tstart, tstop):
+        """ returns the raw (n, 8) columns of the rows between tstart and tstop (s) """
+        return self.read_rows(int(np.ceil(tstart / self.twave)),
+                              int(np.floor(tstop / self.twave)) + 1)
+
+    def data(self):
+        """ returns the lwparse.LdumpData of the file, parsing it on first call """
+        if self._data is None:
+            self._data = lwparse.parse(self.filename, self.yscale, self.avrfac, self.cache,
+                                       self.dtype)
+        return self._data
@@ -0,0 +1,146 @@
+"""
+provides a compact chunked and compressed archive format for ldump data
+
+an archive stores the raw I/Q ADC counts as int16 (or int32 where a chunk needs
+it) in independently zlib compressed chunks of rows, followed by a json index of
+the chunks and the header metadata, so any range of rows can be read by
+decompressing only the chunks it overlaps:
+
+    MAGIC | chunk 0 | chunk 1 | ... | json index | index offset (<Q) | INDEX_MAGIC
+"""
+from __future__ import print_function
+import json
+import struct
+import sys
+import zlib
+import numpy as np
+
+import lwparse
+
+MAGIC = b'LWARCH1\n'
+INDEX_MAGIC = b'LWAINDX\n'
+TRAILER = struct.Struct('<Q')
+CHUNK_ROWS = 1 << 16
+LEVEL = 6
+SUFFIX = '.lwa'
+
+
+def is_archive(filename):
+    """ returns True if filename is an archive """
+    with open(filename, 'rb') as filep:
+        return filep.read(len(MAGIC)) == MAGIC
+
+
+def _chunk_dtype(block):
+    """ returns the smallest of int16 and int32 holding the integer block """
+    if not np.array_equal(block, np.round(block)):
+        raise ValueError("ldump data is not integer ADC counts, can't archive it")
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not block.size or (block.min() >= info.min and block.max() <= info.max):
+            return dtype
+    raise ValueError("ldump data doesn't fit in int32")
+
+
+def convert(source, destination, chunk_rows=CHUNK_ROWS, level=LEVEL):
+    """
+    writes the ldump text file source to the archive destination, reading source
+    chunk_rows rows at a time. returns the number of rows written
+    """
+    wave_samp_per, yscale = lwparse.read_header(source)
+    chunks = []
+    rows = 0
+    with open(destination, 'wb') as filep:
+        filep.write(MAGIC)
+        for block in lwparse.iter_columns(source, chunk_rows):
+            dtype = _chunk_dtype(block)
+            payload = zlib.compress(np.ascontiguousarray(block, dtype=dtype).tobytes(), level)
+            chunks.append({'offset': filep.tell(), 'size': len(payload), 'start': rows,
+                           'rows': block.shape[0], 'dtype': np.dtype(dtype).str})
+            filep.write(payload)
+            rows += block.shape[0]
+
+        index = {'wave_samp_per': wave_samp_per, 'yscale': yscale, 'rows': rows,
+                 'columns': lwparse.COLUMNS, 'chunks': chunks}
+        index_offset = filep.tell()
+        filep.write(json.dumps(index).encode())
+        filep.write(TRAILER.pack(index_offset) + INDEX_MAGIC)
+    return rows
+
+
+class Archive(object):
+    """
+    Represents an ldump archive written by convert. Opening it reads only the index
+
+    Parameters
+    ----------
+    filename : str
+        archive to read
+
+    Returns
+    -------
+    Archive object
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as filep:
+            assert filep.read(len(MAGIC)) == MAGIC, filename + " is not an ldump archive"
+            filep.seek(-(TRAILER.size + len(INDEX_MAGIC)), 2)
+            trailer = filep.read()
+            assert trailer.endswith(INDEX_MAGIC), filename + " has no index, is it complete?"
+            index_offset, = TRAILER.unpack(trailer[:TRAILER.size])
+            filep.seek(index_offset)
+            index = json.loads(filep.read()[:-len(trailer)].decode())
+        self.wave_samp_per = index['wave_samp_per']
+        self.yscale = index['yscale']
+        self.rows = index['rows']
+        self.chunks = index['chunks']
+        self.starts = np.array([chunk['start'] for chunk in self.chunks], dtype=np.int64)
+
+    def _read_chunk(self, filep, chunk):
+        """ returns the decompressed (rows, 8) float64 columns of chunk """
+        filep.seek(chunk['offset'])
+        data = np.frombuffer(zlib.decompress(filep.read(chunk['size'])),
+                             dtype=np.dtype(chunk['dtype']))
+        return data.reshape(chunk['rows'], lwparse.COLUMNS).astype(np.float64)
+
+    def read(self, start=0, stop=None):
+        """
+        returns rows start to stop of the raw columns as an (n, 8) float64
+        np.ndarray, like lwparse.read_columns. only the chunks overlapping the
+        range are decompressed
+        """
+        stop = self.rows if stop is None else min(stop, self.rows)
+        start = max(start, 0)
+        if stop <= start:
+            return np.empty((0, lwparse.COLUMNS))
+
+        first = np.searchsorted(self.starts, start, 'right') - 1
+        last = np.searchsorted(self.starts, stop, 'left')
+        data = np.empty((stop - start, lwparse.COLUMNS))
+        with open(self.filename, 'rb') as filep:
+            for chunk in self.chunks[first:last]:
+                block = self._read_chunk(filep, chunk)
+                low = max(start, chunk['start'])
+                high = min(stop, chunk['start'] + chunk['rows'])
+                data[low - start:high - start] = block[low - chunk['start']:
+                                                       high - chunk['start']]
+        return data
+
+    def iter_chunks(self):
+        """ yields the raw columns one chunk at a time """
+        with open(self.filename, 'rb') as filep:
+            for chunk in self.chunks:
+                yield self._read_chunk(filep, chunk)
+
+
+def main(argv):
+    """ converts the ldump files given in argv to archives next to them """
+    assert len(argv) > 1, "You must provide at least one file"
+    for filename in argv[1:]:
+        rows = convert(filename, filename + SUFFIX)
+        print("{} -> {} ({} rows)".format(filename, filename + SUFFIX, rows))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
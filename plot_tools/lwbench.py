@@ -0,0 +1,185 @@
+"""
+benchmarks the plot_tools stages on synthetic ldump captures
+
+each stage is timed separately and reported as rows/s with the peak memory
+allocated during the stage (numpy allocations are traced by tracemalloc). Results
+are appended as JSON lines (with the git commit) so runs on different commits can
+be compared with --compare
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from timeit import default_timer as timer
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+
+import lwmain
+import lwparse
+import lwplot
+from ldumpfile import LdumpFile
+
+WAVE_SAMP_PER = 255
+YSCALE = 32768
+ROWS = [100000, 1000000]
+RESULTS = 'lwbench_results.jsonl'
+WRITE_ROWS = 1 << 18
+
+
+def write_ldump(filename, rows, wave_samp_per=WAVE_SAMP_PER, yscale=YSCALE, seed=0):
+    """
+    writes a synthetic ldump capture of rows rows: the 4 line header followed by
+    8 integer I/Q columns, one pair per board. each board is a slowly modulated
+    carrier with noise, with a comment row every WRITE_ROWS rows like real dumps
+    """
+    rng = np.random.RandomState(seed)
+    with open(filename, 'w') as filep:
+        filep.write("# synthetic ldump capture\n")
+        filep.write("# wave_samp_per is {}\n".format(wave_samp_per))
+        filep.write("# yscale is {}\n".format(yscale))
+        filep.write("# " + " ".join(lwmain.BOARDS) + "\n")
+        for start in range(0, rows, WRITE_ROWS):
+            count = min(WRITE_ROWS, rows - start)
+            t = np.arange(start, start + count)
+            cols = np.empty((count, lwparse.COLUMNS), dtype=np.int64)
+            for board in range(lwparse.BOARDS):
+                amp = 0.6 * yscale * (1 + 0.02 * np.sin(t / 5000.0 + board)) + \
+                    rng.normal(0, 50, count)
+                phase = 0.3 * board + 0.01 * np.sin(t / 3000.0) + rng.normal(0, 0.002, count)
+                cols[:, 2 * board] = np.round(amp * np.cos(phase))
+                cols[:, 2 * board + 1] = np.round(amp * np.sin(phase))
+            np.savetxt(filep, cols, fmt='%d')
+            filep.write("#\n")
+
+
+def measure(func, *args):
+    """
+    returns (result, seconds, peak bytes allocated) of func(*args)
+    tracemalloc slows allocation heavy code a lot, so func is timed on its own and
+    then called a second time with tracing for the peak
+    """
+    start = timer()
+    result = func(*args)
+    seconds = timer() - start
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench(filename, rows):
+    """ returns {stage: {'seconds', 'rows_per_s', 'peak_mb'}} for capture filename """
+    results = {}
+
+    def record(stage, func, *args):
+        result, seconds, peak = measure(func, *args)
+        results[stage] = {'seconds': seconds, 'rows_per_s': rows / seconds,
+                          'peak_mb': peak / 1e6}
+        print("{:>14} {:>10.3f} s {:>14.0f} rows/s {:>10.1f} MB".format(
+            stage, seconds, rows / seconds, peak / 1e6))
+        return result
+
+    data = record('parse', lwparse.parse, filename, YSCALE, lwmain.AVRFAC, False)
+    # parse is lazy, derived quantities are computed (and cached) on first access
+    def derive():
+        fresh = lwparse.LdumpData(data.columns, YSCALE, lwmain.AVRFAC)
+        return [list(fresh[key]) for key in ('abs', 'avr', 'phase')]
+    record('derive', derive)
+    lwparse.load_columns(filename)
+    record('parse_cache', lwparse.parse, filename, YSCALE, lwmain.AVRFAC)
+    amplitude = np.column_stack(data['abs'])
+    record('moving_mean', lwparse.moving_mean, amplitude, lwmain.AVRFAC)
+    # the time and frequency axes of the capture, as lwmain gets them
+    ldump = LdumpFile(filename, lwmain.AVRFAC)
+    taxis = ldump.taxis()
+    faxis = ldump.faxis()
+    record('xyreduce_lin', lwplot.xyreduce, taxis, data['abs'][0], 'lin')
+    record('xyreduce_log', lwplot.xyreduce, taxis, data['abs'][0], 'log')
+
+    fig = plt.figure()
+    record('nplot_fft', lwplot.nplot_fft, fig.add_subplot(1, 2, 1), faxis, data['raw'][0],
+           True)
+    record('plot_bottom', lwplot.plot_bottom, fig.add_subplot(1, 2, 2), data['raw'][0],
+           False, '.')
+    record('savefig', fig.savefig, filename + '_bench.png')
+    plt.close(fig)
+
+    record('lwmain', lwmain.render, filename)
+    return results
+
+
+def git_commit():
+    """ returns the current git commit of the tree, or None """
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def compare(results_file, rows=None):
+    """ prints every stored run of each stage side by side, one column per run """
+    with open(results_file) as filep:
+        runs = [json.loads(line) for line in filep if line.strip()]
+    if rows:
+        runs = [run for run in runs if run['rows'] in rows]
+    for size in sorted(set(run['rows'] for run in runs)):
+        sized = [run for run in runs if run['rows'] == size]
+        print("\n{} rows, rows/s".format(size))
+        print("{:>14}".format('') + "".join("{:>14}".format(run['commit'] or '?')
+                                             for run in sized))
+        for stage in sorted(set(stage for run in sized for stage in run['stages'])):
+            cells = [run['stages'].get(stage, {}).get('rows_per_s') for run in sized]
+            print("{:>14}".format(stage) + "".join(
+                "{:>14.0f}".format(cell) if cell else "{:>14}".format('-') for cell in cells))
+
+
+def main(argv):
+    """ runs the benchmarks given by argv """
+    parser = argparse.ArgumentParser(description="Benchmark plot_tools on synthetic captures")
+    parser.add_argument("-r", "--rows", type=float, nargs='+', default=ROWS,
+                        help="capture sizes to benchmark (eg. 1e5 1e8)")
+    parser.add_argument("-o", "--output", default=RESULTS, help="results file to append to")
+    parser.add_argument("-d", "--dir", help="directory for the captures (kept), "
+                        "a temporary directory if not given")
+    parser.add_argument("-c", "--compare", action="store_true",
+                        help="only print the stored results")
+    args = parser.parse_args(argv[1:])
+    sizes = [int(rows) for rows in args.rows]
+
+    if args.compare:
+        compare(args.output, sizes)
+        return
+
+    workdir = args.dir or tempfile.mkdtemp(prefix='lwbench')
+    try:
+        for rows in sizes:
+            filename = os.path.join(workdir, 'synthetic_{}.ldump'.format(rows))
+            if not os.path.exists(filename):
+                print("writing " + filename)
+                write_ldump(filename, rows)
+            print("\n{} rows".format(rows))
+            run = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'rows': rows, 'stages': bench(filename, rows)}
+            with open(args.output, 'a') as filep:
+                filep.write(json.dumps(run, sort_keys=True) + '\n')
+    finally:
+        if not args.dir:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,33 +1,68 @@
 #lw3overlay.py
-import re
+""" overlays the moving average amplitude of board 3 for several ldump files """
+from __future__ import print_function
+import argparse
 import sys
+from multiprocessing import Pool
 import numpy as np
 from matplotlib import pyplot as plt
 
-import lwparse
 import lwplot
+from ldumpfile import LdumpFile
 
 AVRFAC = 512
-FCLK = 1300e6 / 7.0 * 11 / 20
+BOARD = 2
 
-assert len(sys.argv) > 1, "You must provide at least one file"
 
-# avr_data = []
-# taxis = []
+def load_reduced(filename):
+    """
+    parses filename and returns the reduced (taxis, avr) of BOARD
+    runs in a worker process, so only the small reduced arrays are sent back
+    """
+    ldump = LdumpFile(filename, AVRFAC)
+    avr_data = ldump.data()['avr'][BOARD]
+    taxis = np.arange(avr_data.size) * ldump.twave
+    return lwplot.xyreduce(taxis, avr_data)
 
-ax = plt.subplot(111)
-for filename in sys.argv[1:]:
-    filep = open(filename)
-    scale = filep.read().split('\n')
-    filep.close()
 
-    wave_samp_per = int(re.match(r'# wave_samp_per is (\d*)', scale[1]).group(1))
-    yscale = int(re.match(r'# yscale is (\d*)', scale[2]).group(1))
+def load_pyramid(filename):
+    """ parses filename and returns a lwplot.LodPyramid of BOARD's average """
+    ldump = LdumpFile(filename, AVRFAC)
+    avr_data = ldump.data()['avr'][BOARD]
+    return lwplot.LodPyramid(np.arange(avr_data.size) * ldump.twave, avr_data)
 
-    data = lwparse.parse(filename, yscale, AVRFAC)
-    taxis = (np.arange(data['avr'][2].size) * (wave_samp_per / FCLK) * 22 * 2)
-    avr_data = data['avr'][2]
 
-    lwplot.plot(ax, taxis, avr_data, True)
+def main(argv):
+    """ plots the overlay of the files given in argv """
+    parser = argparse.ArgumentParser(description="Overlay ldump amplitude averages")
+    parser.add_argument("files", nargs='+', help="ldump files to overlay")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of files to parse in parallel (0 for one per core)")
+    parser.add_argument("-z", "--zoom", action="store_true",
+                        help="keep full resolution data and redraw detail when zooming")
+    args = parser.parse_args(argv[1:])
 
-plt.show()
\ No newline at end of file
+    load = load_pyramid if args.zoom else load_reduced
+    if args.jobs == 1:
+        loaded = [load(filename) for filename in args.files]
+    else:
+        pool = Pool(args.jobs or None)
+        try:
+            # map keeps command line order regardless of which file finishes first
+            loaded = pool.map(load, args.files)
+        finally:
+            pool.close()
+            pool.join()
+
+    ax = plt.subplot(111)
+    for item in loaded:
+        if args.zoom:
+            lwplot.plot_lod(ax, item)
+        else:
+            lwplot.plot(ax, item[0], item[1], False)
+
+    plt.show()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
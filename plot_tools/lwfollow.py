@@ -0,0 +1,138 @@
+""" follows a growing ldump capture and keeps its plots up to date """
+from __future__ import print_function
+import argparse
+import sys
+import numpy as np
+from matplotlib import pyplot as plt
+
+import lwparse
+import lwplot
+import lwspectrum
+from ldumpfile import LdumpFile
+
+AVRFAC = 512
+REDUCE_FACTOR = 1024
+NPERSEG = 1 << 14
+REFRESH = 2.0
+
+COLS = 4
+BOARDS = ['llrf1','llrf1molk1','llrf1molk2','llrf2molk1']
+
+
+class Follower(object):
+    """
+    incrementally updated statistics of a growing ldump capture: moving means of
+    the amplitude and phase, reduced amplitude and phase traces and the Welch
+    spectrum of every board. update() only parses rows appended since the last call
+    """
+
+    def __init__(self, filename, avrfac=AVRFAC, factor=REDUCE_FACTOR, nperseg=NPERSEG):
+        self.ldump = LdumpFile(filename, avrfac)
+        self.tail = lwparse.TailReader(filename)
+        self.avrfac = avrfac
+        self.factor = factor
+        self.nperseg = nperseg
+        self.reset()
+
+    def reset(self):
+        """ forgets everything seen so far """
+        self.rows = 0
+        self.abs_avr = lwparse.MovingMean(self.avrfac)
+        self.phase = lwparse.PhaseTracker()
+        self.phase_avr = lwparse.MovingMean(self.avrfac)
+        self.spectrum = lwspectrum.WelchAccumulator(self.nperseg,
+                                                    fs=1.0 / self.ldump.twave)
+        # one reducer per board for each of abs, avr, phase and phase avr
+        self.traces = dict((name, [lwplot.StreamReducer(self.factor) for _ in range(COLS)])
+                           for name in ('abs', 'avr', 'phase', 'phase_avr'))
+
+    def update(self):
+        """ parses the new rows, returns how many there were """
+        if self.tail.truncated():
+            print("capture restarted")
+            self.tail.reset()
+            self.reset()
+        data = self.tail.read()
+        rows = data.shape[0]
+        if not rows:
+            return 0
+
+        raw = (data[:, 0::2] + 1j * data[:, 1::2]) / self.ldump.yscale
+        amplitude = abs(raw)
+        phase = self.phase.update(raw)
+        values = {'abs': amplitude, 'avr': self.abs_avr.update(amplitude),
+                  'phase': phase, 'phase_avr': self.phase_avr.update(phase)}
+        taxis = (self.rows + np.arange(rows)) * self.ldump.twave
+        for name, reducers in self.traces.items():
+            for i, reducer in enumerate(reducers):
+                reducer.update(taxis, values[name][:, i])
+        self.spectrum.update(raw)
+        self.rows += rows
+        return rows
+
+    def freqs(self):
+        """ returns the frequency of each spectrum bin """
+        return lwspectrum.frequencies(self.nperseg, self.ldump.twave)
+
+
+def follow(filename, refresh=REFRESH, **kwargs):
+    """
+    plots the amplitude, phase and spectrum of each board of filename and refreshes
+    them every refresh seconds with the rows appended since, until the window closes
+    """
+    follower = Follower(filename, **kwargs)
+    plt.ion()
+    fig = plt.figure(figsize=(30, 15))
+    lines = {}
+    for i in range(COLS):
+        ax = fig.add_subplot(3, COLS, i + 1)
+        lines['abs', i], = ax.plot([], [], 'y')
+        lines['avr', i], = ax.plot([], [], 'b')
+        ax.set_title("Amplitude vs Time (" + BOARDS[i] + ")")
+        ax.set_xlabel("Time (s)")
+        ax.set_ylabel("Amplitude (% of FS)")
+
+        ax = fig.add_subplot(3, COLS, i + 5)
+        lines['phase', i], = ax.plot([], [], 'y')
+        lines['phase_avr', i], = ax.plot([], [], 'b')
+        ax.set_title("Phase vs Time (" + BOARDS[i] + ")")
+        ax.set_xlabel("Time (s)")
+        ax.set_ylabel("Phase (rad)")
+
+        ax = fig.add_subplot(3, COLS, i + 9)
+        lines['fft', i], = ax.loglog([], [])
+        ax.set_title("Power Spectrum vs Frequency (" + BOARDS[i] + ")")
+        ax.set_xlabel("Freq (Hz)")
+        ax.set_ylabel("Spectral Density (FS/sqrt(Hz))")
+
+    while plt.fignum_exists(fig.number):
+        if follower.update():
+            for (name, i), line in lines.items():
+                if name != 'fft':
+                    reducer = follower.traces[name][i]
+                    line.set_data(reducer.x, reducer.y)
+            power = follower.spectrum.power()
+            if power is not None:
+                for i in range(COLS):
+                    lines['fft', i].set_data(follower.freqs()[1:], np.sqrt(power[1:, i]))
+            for ax in fig.axes:
+                ax.relim()
+                ax.autoscale_view()
+            fig.suptitle("{} ({} rows)".format(filename, follower.rows))
+        plt.pause(refresh)
+
+
+def main(argv):
+    """ follows the ldump file given in argv """
+    parser = argparse.ArgumentParser(description="Live plots of a growing ldump capture")
+    parser.add_argument("filename", help="ldump file being written")
+    parser.add_argument("-r", "--refresh", type=float, default=REFRESH,
+                        help="seconds between refreshes")
+    parser.add_argument("-n", "--nperseg", type=int, default=NPERSEG,
+                        help="spectrum segment length")
+    args = parser.parse_args(argv[1:])
+    follow(args.filename, args.refresh, nperseg=args.nperseg)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
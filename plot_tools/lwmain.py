@@ -1,10 +1,14 @@
 # """ produces useful graphs from provided ldump file """
 from __future__ import absolute_import
 from __future__ import print_function
-import re
+import argparse
+import functools
+import glob
+import itertools
+import os
 import sys
-# import glob
-# import os
+import traceback
+from multiprocessing import Pool
 # import time
 import numpy as np
 import pandas as pd
@@ -13,8 +17,11 @@ from matplotlib import pyplot as plt
 
 import lwparse
 import lwplot
+import lwraster
+import lwspectrum
+import stagetimer
+from ldumpfile import LdumpFile
 
-FCLK = 1300e6 / 7.0 * 11 / 20
 AVRFAC = 512
 SAMPLE_STEP = 1
 
@@ -25,87 +32,309 @@ REDUCE1 = True
 REDUCE2 = True
 HEATMAP3 = False
 
+# Welch segment length of the spectra, None for a single full length fft
+FFT_NPERSEG = 1 << 12
+
+# optional fifth row of spectrograms, at most SPECTROGRAM_TIMES spectra wide
+SPECTROGRAM = False
+SPECTROGRAM_NPERSEG = 1 << 12
+SPECTROGRAM_TIMES = 512
+
+# optional page of coherence and lag correlation of every pair of boards
+XBOARD = False
+XBOARD_NPERSEG = 1 << 12
+# largest lag (rows) shown on the correlation plots
+XBOARD_LAGS = 256
+
+# draw the pngs with lwraster instead of matplotlib
+RASTER = False
+
+# precision of the parsed samples, np.float32 halves memory (see lwparse.LdumpData)
+DTYPE = np.float64
+
 BOARDS = ['llrf1','llrf1molk1','llrf1molk2','llrf2molk1']
 
 
 def main(argv):
-    """ produces useful graphs from given ldump file """
-    filename = None
+    """
+    produces useful graphs from given ldump file
+    given several files, directories or glob patterns, renders them all in batch
+    """
+    parser = argparse.ArgumentParser(description="Plot ldump captures")
+    parser.add_argument("paths", nargs='+',
+                        help="ldump file, or files, directories and glob patterns to batch")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="batch worker processes (default one per core)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="re-render files whose pngs are up to date")
+    parser.add_argument("-s", "--spectrogram", action="store_true", default=SPECTROGRAM,
+                        help="add a row of spectrograms")
+    parser.add_argument("-x", "--xboard", action="store_true", default=XBOARD,
+                        help="add a page comparing every pair of boards")
+    parser.add_argument("-r", "--raster", action="store_true", default=RASTER,
+                        help="draw with the numpy rasterizer (fast, plain axes)")
+    parser.add_argument("--single", dest="dtype", action="store_const", const=np.float32,
+                        default=DTYPE, help="parse to float32/complex64 samples")
+    parser.add_argument("-p", "--profile", action="store_true",
+                        help="print the time spent in each stage at exit (see stagetimer)")
+    parser.add_argument("--profile-json", metavar='FILE',
+                        help="write the time spent in each stage to FILE at exit")
+    args = parser.parse_args(argv[1:])
+
+    if args.profile or args.profile_json:
+        stagetimer.enable(args.profile_json)
+
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]):
+        render(args.paths[0], args.spectrogram, args.raster, args.dtype, args.xboard)
+    else:
+        batch(find_captures(args.paths), args.jobs, args.force, args.spectrogram,
+              args.raster, args.dtype, args.xboard)
+
+
+def find_captures(paths):
+    """
+    returns the sorted ldump files given by paths, which may be files, directories
+    (not recursed) or glob patterns. files without an ldump header are skipped
+    """
+    found = set()
+    for path in paths:
+        matches = [path] if os.path.exists(path) else glob.glob(path)
+        for match in matches:
+            if os.path.isdir(match):
+                found.update(os.path.join(match, name) for name in os.listdir(match))
+            else:
+                found.add(match)
+    return sorted(name for name in found if os.path.isfile(name) and is_capture(name))
+
+
+def is_capture(filename):
+    """ returns True if filename starts with an ldump header """
+    try:
+        lwparse.read_header(filename)
+    except (AttributeError, IndexError, ValueError, IOError):
+        return False
+    return True
+
+
+def outputs(filename, xboard=False):
+    """ returns the names of the pngs render writes for filename """
+    pngs = [filename + '_grid.png', filename + '.png']
+    return pngs + [filename + '_xboard.png'] if xboard else pngs
 
-    if len(argv) >= 2:
-        filename = argv[1]
 
-    assert filename, "Filename must be provided!"
+def up_to_date(filename, xboard=False):
+    """ returns True if every png of filename is newer than filename """
+    mtime = os.path.getmtime(filename)
+    return all(os.path.exists(png) and os.path.getmtime(png) >= mtime
+               for png in outputs(filename, xboard))
 
-    filep = open(filename)
-    scale = filep.read().split('\n')
-    filep.close()
 
-    wave_samp_per = int(
-        re.match(r'# wave_samp_per is (\d*)', scale[1]).group(1))
-    yscale = int(re.match(r'# yscale is (\d*)', scale[2]).group(1))
+def batch(filenames, jobs=0, force=False, spectrogram=SPECTROGRAM, raster=RASTER,
+          dtype=DTYPE, xboard=XBOARD):
+    """
+    renders filenames on the non-interactive Agg backend with a pool of jobs worker
+    processes (one per core if 0). files whose pngs are up to date are skipped
+    unless force is True. returns the list of (filename, error) that failed
+    """
+    todo = [name for name in filenames if force or not up_to_date(name, xboard)]
+    print("{} captures, {} to render".format(len(filenames), len(todo)))
+    if not todo:
+        return []
 
-    tsamp = 1 / FCLK
-    twave = (wave_samp_per / FCLK) * 22 * 2
+    plt.switch_backend('Agg')
+    pool = Pool(jobs or None, initializer=plt.switch_backend, initargs=('Agg',))
+    failed = []
+    try:
+        render_file = functools.partial(_batch_render, spectrogram=spectrogram,
+                                        raster=raster, dtype=dtype, xboard=xboard)
+        for filename, error, stats in pool.imap_unordered(render_file, todo):
+            stagetimer.merge(stats)
+            if error:
+                failed.append((filename, error))
+                print("FAILED " + filename + "\n" + error)
+            else:
+                print("rendered " + filename)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
 
-    data = lwparse.parse(filename, yscale, AVRFAC)
-    dsize = data['raw'][0].size
 
-    print(wave_samp_per, tsamp, twave, twave * 1023, yscale, dsize)
+def _batch_render(filename, spectrogram=SPECTROGRAM, raster=RASTER, dtype=DTYPE,
+                  xboard=XBOARD):
+    """
+    renders filename in a batch worker
+    returns (filename, traceback or None, stage timings of the render)
+    """
+    stagetimer.reset()
+    try:
+        render(filename, spectrogram, raster, dtype, xboard)
+    except Exception:
+        plt.close('all')
+        return filename, traceback.format_exc(), stagetimer.stats()
+    return filename, None, stagetimer.stats()
 
-    taxis = np.arange(dsize) * twave
-    fwave = 1.0 / twave / dsize
-    faxis = np.arange(dsize) * fwave
-    fig = plt.figure(1, figsize=(30, 20))
-    plt.gca().ticklabel_format(useOffset=False)
+
+def render(filename, spectrogram=SPECTROGRAM, raster=RASTER, dtype=DTYPE, xboard=XBOARD):
+    """
+    renders the graphs of ldump file filename to the pngs named by outputs
+    if spectrogram is True a row of spectrograms is added to the grid
+    if raster is True the pngs are drawn by lwraster rather than matplotlib
+    dtype is the precision the capture is parsed to
+    if xboard is True a page comparing the boards is rendered too (render_xboard)
+    """
+    rows = ROWS + 1 if spectrogram else ROWS
+    with stagetimer.stage('parse'):
+        ldump = LdumpFile(filename, AVRFAC, dtype=dtype)
+        data = ldump.data()
+        list(data['raw'])
+    with stagetimer.stage('derive'):
+        # derived quantities are lazy, every one is plotted so compute them here
+        for key in ('abs', 'avr', 'phase'):
+            list(data[key])
+    dsize = ldump.rows
+
+    print(ldump.wave_samp_per, ldump.tsamp, ldump.twave, ldump.twave * 1023,
+          ldump.yscale, dsize)
+
+    taxis = ldump.taxis()
+    if raster:
+        fig = lwraster.Grid(rows, COLS)
+    else:
+        fig = plt.figure(1, figsize=(30, 5 * rows))
+        plt.gca().ticklabel_format(useOffset=False)
 
     # plot first row
-    for i in range(COLS):
-        ax = plt.subplot(ROWS, COLS, i + 1)
-        lwplot.plot(ax, taxis, data['abs'][i], REDUCE1, 'y')
-        lwplot.plot(ax, taxis, data['avr'][i], REDUCE1, 'b')
-        ax.set_title("Amplitude vs Time (" + BOARDS[i] + ")")
-        ax.set_xlabel("Time (s)")
-        ax.set_ylabel("Amplitude (% of FS)")
+    with stagetimer.stage('render'):
+        for i in range(COLS):
+            ax = fig.add_subplot(rows, COLS, i + 1)
+            lwplot.plot(ax, taxis, data['abs'][i], REDUCE1, 'y')
+            lwplot.plot(ax, taxis, data['avr'][i], REDUCE1, 'b')
+            ax.set_title("Amplitude vs Time (" + BOARDS[i] + ")")
+            ax.set_xlabel("Time (s)")
+            ax.set_ylabel("Amplitude (% of FS)")
 
     # plot second row
-    for i in range(COLS):
-        ax = plt.subplot(ROWS, COLS, i + 5)
-        # lwplot.plot_phase(ax, taxis, data['raw'][i], REDUCE2)
-        z = data['raw'][i]
-        y = np.unwrap(np.angle(z) - np.angle(z.mean()))
-        lwplot.plot(ax, taxis, y, REDUCE2, 'y')
-        lwplot.plot(ax, taxis, lwparse.moving_mean(y, AVRFAC), REDUCE2, 'b')
-        ax.set_title("Phase vs Time (" + BOARDS[i] + ")")
-        ax.set_xlabel("Time (s)")
-        ax.set_ylabel("Phase (rad)")
+    with stagetimer.stage('derive'):
+        phase_avr = lwparse.moving_mean(np.column_stack(data['phase']), AVRFAC)
+    with stagetimer.stage('render'):
+        for i in range(COLS):
+            ax = fig.add_subplot(rows, COLS, i + 5)
+            # lwplot.plot_phase(ax, taxis, data['raw'][i], REDUCE2)
+            lwplot.plot(ax, taxis, data['phase'][i], REDUCE2, 'y')
+            lwplot.plot(ax, taxis, phase_avr[:, i], REDUCE2, 'b')
+            ax.set_title("Phase vs Time (" + BOARDS[i] + ")")
+            ax.set_xlabel("Time (s)")
+            ax.set_ylabel("Phase (rad)")
 
     # plot third row
-    for i in range(COLS):
-        ax = plt.subplot(ROWS, COLS, i + 9)
-        lwplot.plot_bottom(ax, data['raw'][i][::SAMPLE_STEP], HEATMAP3, '.')
-        ax.set_title("Q vs I (" + BOARDS[i] + ")")
-        ax.set_xlabel("I (au)")
-        ax.set_ylabel("Q (au)")
-
-    for i in range(COLS):
-        ax = plt.subplot(ROWS, COLS, i + 13)
-        lwplot.nplot_fft(ax, faxis, data['raw'][i], True)
-        ax.set_title("Power Spectrum vs Frequency (" + BOARDS[i] + ")")
-        ax.set_xlabel("Freq (Hz)")
-        ax.set_ylabel("Power Spectrum (dbFS)")
-
-    plt.suptitle(filename)
+    with stagetimer.stage('render'):
+        for i in range(COLS):
+            ax = fig.add_subplot(rows, COLS, i + 9)
+            lwplot.plot_bottom(ax, data['raw'][i][::SAMPLE_STEP], HEATMAP3, '.')
+            ax.set_title("Q vs I (" + BOARDS[i] + ")")
+            ax.set_xlabel("I (au)")
+            ax.set_ylabel("Q (au)")
+
+    # all boards are transformed together, FFT_NPERSEG None is one full length segment
+    nperseg = min(FFT_NPERSEG or dsize, dsize)
+    with stagetimer.stage('fft'):
+        power = lwspectrum.welch(list(data['raw']), nperseg, fs=1.0 / ldump.twave)
+    freqs = lwspectrum.frequencies(nperseg, ldump.twave)
+    with stagetimer.stage('render'):
+        for i in range(COLS):
+            ax = fig.add_subplot(rows, COLS, i + 13)
+            lwplot.plot_spectrum(ax, freqs, power[:, i], True)
+            ax.set_title("Power Spectrum vs Frequency (" + BOARDS[i] + ")")
+            ax.set_xlabel("Freq (Hz)")
+            ax.set_ylabel("Spectral Density (FS/sqrt(Hz))")
+
+    if spectrogram:
+        plot_spectrograms(fig, data, dsize, ldump.twave, rows)
+
+    fig.suptitle(filename)
     # plt.grid()
 
-    plt.savefig(filename + '_grid.png')
-    plt.figure(2)
-    plt.plot(data['avr'][2][::SAMPLE_STEP], data['avr'][1][::SAMPLE_STEP])
-    plt.suptitle(filename)
+    grid_png, png = outputs(filename)[:2]
+    with stagetimer.stage('save'):
+        fig.savefig(grid_png)
+    fig = lwraster.Grid(1, 1) if raster else plt.figure(2)
+    with stagetimer.stage('render'):
+        ax = fig.add_subplot(1, 1, 1)
+        ax.plot(data['avr'][2][::SAMPLE_STEP], data['avr'][1][::SAMPLE_STEP])
+    fig.suptitle(filename)
     
     # fig.tight_layout()
     # plt.show()
-    plt.savefig(filename + '.png')
+    with stagetimer.stage('save'):
+        fig.savefig(png)
+
+    if xboard:
+        render_xboard(filename, data, ldump.twave, raster)
+    # figures are reused by number, so a batch worker must start from scratch
+    plt.close('all')
+
+
+def render_xboard(filename, data, twave, raster=RASTER):
+    """
+    renders the cross board page, filename + '_xboard.png': the magnitude squared
+    coherence (top) and lag correlation (bottom) of every pair of boards, all from
+    a single batched fft of the boards (lwspectrum.cross_spectra)
+    """
+    nperseg = min(XBOARD_NPERSEG, data.columns.shape[0])
+    with stagetimer.stage('fft'):
+        csd = lwspectrum.cross_spectra(list(data['raw']), nperseg, onesided=False)
+        msc = lwspectrum.coherence(csd)
+        lags, corr = lwspectrum.correlation(csd, nperseg)
+    freqs = np.fft.fftshift(np.fft.fftfreq(nperseg, twave))
+    shown = abs(lags) <= XBOARD_LAGS
+
+    pairs = list(itertools.combinations(range(COLS), 2))
+    if raster:
+        fig = lwraster.Grid(2, len(pairs))
+    else:
+        fig = plt.figure(3, figsize=(5 * len(pairs), 10))
+    with stagetimer.stage('render'):
+        for n, (i, j) in enumerate(pairs):
+            pair = BOARDS[i] + " / " + BOARDS[j]
+            ax = fig.add_subplot(2, len(pairs), n + 1)
+            ax.plot(freqs, np.fft.fftshift(msc[:, i, j]))
+            ax.set_title("Coherence (" + pair + ")")
+            ax.set_xlabel("Freq (Hz)")
+            ax.set_ylabel("Magnitude squared coherence")
+
+            ax = fig.add_subplot(2, len(pairs), len(pairs) + n + 1)
+            ax.plot(lags[shown] * twave, abs(corr[shown, i, j]))
+            ax.set_title("Correlation (" + pair + ")")
+            ax.set_xlabel("Lag (s)")
+            ax.set_ylabel("|Correlation coefficient|")
+    fig.suptitle(filename)
+    with stagetimer.stage('save'):
+        fig.savefig(outputs(filename, True)[2])
+
+
+def plot_spectrograms(fig, data, dsize, twave, rows):
+    """
+    plots the spectrogram of each board on the last row of the grid fig. segments are
+    averaged so there are at most SPECTROGRAM_TIMES spectra, which bounds memory
+    """
+    nperseg = min(SPECTROGRAM_NPERSEG, dsize)
+    step = nperseg // 2
+    segments = 1 + (dsize - nperseg) // step
+    decimate = max(1, -(-segments // SPECTROGRAM_TIMES))
+    with stagetimer.stage('fft'):
+        starts, power = lwspectrum.spectrogram(data.iter_blocks(), nperseg,
+                                               decimate=decimate, fs=1.0 / twave)
+    # each spectrum is placed at the middle of the rows it covers
+    times = (starts + ((decimate - 1) * step + nperseg) / 2.0) * twave
+    freqs = lwspectrum.frequencies(nperseg, twave)
+    with stagetimer.stage('render'):
+        for i in range(COLS):
+            ax = fig.add_subplot(rows, COLS, (rows - 1) * COLS + i + 1)
+            lwplot.plot_spectrogram(ax, times, freqs, power[:, :, i])
+            ax.set_title("Spectrogram (" + BOARDS[i] + ")")
+            ax.set_xlabel("Time (s)")
+            ax.set_ylabel("Freq (Hz)")
 
 
 if __name__ == "__main__":
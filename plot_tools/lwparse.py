@@ -1,34 +1,463 @@
 """ provides a function to parse data from ldump into useful format """
+import io
+import json
+import os
+import re
+import tempfile
 import numpy as np
 import pandas as pd
 
+import lwarchive
 
-def parse(filename, yscale, avrfac):
+HEADER_ROWS = 4
+BOARDS = 4
+COLUMNS = 2 * BOARDS
+BLOCK_ROWS = 1 << 18
+
+CACHE_SUFFIX = '.lwcache'
+CACHE_MAGIC = b'LWCACHE1\n'
+CACHE_HEADER_SIZE = 4096
+
+# precision of parsed samples, np.float32 halves the memory (and memory bandwidth)
+# of every derived quantity. see LdumpData for the error this costs
+DTYPE = np.float64
+
+
+def parse(filename, yscale, avrfac, cache=True, dtype=DTYPE):
+    """
+    parse ldump file to a LdumpData object containing raw data (complex), absolute
+    values of data, a moving average with window of avrfac and the phase of each
+    board. Data is scaled using yscale
+    if cache is True the parsed columns are kept in a binary sidecar next to filename
+    and memory mapped on later calls (see load_columns)
+    dtype (np.float64 or np.float32) is the precision of the derived quantities
+    """
+    data, _ = load_columns(filename, cache)
+    return LdumpData(data, yscale, avrfac, dtype)
+
+
+def complex_dtype(dtype):
+    """ returns the complex dtype matching the float dtype (complex64 for float32) """
+    return np.result_type(dtype, np.complex64)
+
+
+def scale_raw(real, imag, yscale, dtype=DTYPE):
+    """
+    returns (real + 1j * imag) / yscale as complex_dtype(dtype), real and imag being
+    float64 columns. each part is divided in float64 and rounded once to dtype, so
+    it's correctly rounded for any yscale (a float64 quotient of float32 operands
+    rounds to the same float32 as the exact one)
+    """
+    raw = np.empty(real.shape, dtype=complex_dtype(dtype))
+    raw.real = real / float(yscale)
+    raw.imag = imag / float(yscale)
+    return raw
+
+
+class LdumpData(object):
+    """
+    parsed ldump data, indexed by quantity then board like the dict parse used to
+    return, eg. data['avr'][2]. quantities are 'raw', 'abs', 'avr' and 'phase'
+    each quantity is computed for a board when it is first accessed, then cached
+
+    with dtype np.float32 'raw' is complex64 and the rest float32, while means and
+    running sums are still accumulated in float64. ADC counts are exact in float32,
+    so compared with np.float64 the error is only rounding of the results: the
+    real and imaginary parts of 'raw' within 2 ** -24 (6e-8) relative (see
+    scale_raw, iter_parse rounds the same way), 'abs' within 2 ** -22
+    (2.4e-7) relative, 'avr' within 2 ** -22 of the largest amplitude and 'phase'
+    within 1e-6 rad plus a few float32 ulps of the largest unwrapped phase.
+    lwspectrum.welch of complex64 boards is within 1e-6 of each board's total
+    power in every bin
+    """
+
+    def __init__(self, columns, yscale, avrfac, dtype=DTYPE):
+        self.columns = columns
+        self.yscale = yscale
+        self.avrfac = avrfac
+        self.dtype = np.dtype(dtype)
+        self.quantities = {
+            'raw': LazyBoards(self._raw),
+            'abs': LazyBoards(self._abs),
+            'avr': LazyBoards(self._avr),
+            'phase': LazyBoards(self._phase),
+        }
+
+    def __getitem__(self, key):
+        return self.quantities[key]
+
+    def __contains__(self, key):
+        return key in self.quantities
+
+    def keys(self):
+        """ returns the names of the available quantities """
+        return self.quantities.keys()
+
+    def iter_blocks(self, block_rows=BLOCK_ROWS):
+        """
+        yields dicts with the 'raw' (n, 4) np.ndarray of every block_rows rows, like
+        iter_parse, computed from the columns block by block
+        """
+        for start in range(0, self.columns.shape[0], block_rows):
+            block = LdumpData(self.columns[start:start + block_rows], self.yscale,
+                              self.avrfac, self.dtype)
+            yield {'raw': np.column_stack(block['raw'])}
+
+    def _raw(self, i):
+        """ board i as a complex np array """
+        return scale_raw(self.columns[:, i * 2], self.columns[:, i * 2 + 1], self.yscale,
+                         self.dtype)
+
+    def _abs(self, i):
+        """ magnitude of board i """
+        return abs(self['raw'][i])
+
+    def _avr(self, i):
+        """ moving average of the magnitude of board i """
+        return moving_mean(self['abs'][i], self.avrfac)
+
+    def _phase(self, i):
+        """ unwrapped phase of board i relative to the phase of its mean """
+        z = self['raw'][i]
+        reference = self.dtype.type(np.angle(z.mean(dtype=np.complex128)))
+        return np.unwrap(np.angle(z) - reference)
+
+
+class LazyBoards(object):
+    """ sequence of per board values computed by func(board) on first access """
+
+    def __init__(self, func, boards=BOARDS):
+        self.func = func
+        self.boards = boards
+        self.cache = {}
+
+    def __len__(self):
+        return self.boards
+
+    def __iter__(self):
+        for i in range(self.boards):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.boards:
+            raise IndexError("board {} out of range".format(i))
+        if i not in self.cache:
+            self.cache[i] = self.func(i)
+        return self.cache[i]
+
+
+def read_header(filename):
+    """ returns (wave_samp_per, yscale) from the header lines of an ldump file """
+    if lwarchive.is_archive(filename):
+        archive = lwarchive.Archive(filename)
+        return archive.wave_samp_per, archive.yscale
+    with open(filename) as filep:
+        lines = [filep.readline() for _ in range(HEADER_ROWS)]
+    wave_samp_per = int(
+        re.match(r'# wave_samp_per is (\d*)', lines[1]).group(1))
+    yscale = int(re.match(r'# yscale is (\d*)', lines[2]).group(1))
+    return wave_samp_per, yscale
+
+
+def read_columns(filename, skiprows=HEADER_ROWS):
+    """
+    reads the 8 raw I/Q columns of an ldump file (or any file like object of rows)
+    into an (N, 8) np.ndarray
+    """
+    data = pd.read_csv(filename, skiprows=skiprows, sep=' ', names=range(
+        COLUMNS), na_values='#', dtype=np.float64, engine='c')
+    return np.ascontiguousarray(data.dropna().values, dtype=np.float64)
+
+
+def count_rows(filename):
+    """
+    returns the number of data rows in an ldump file without parsing it
+    the cache sidecar is used when valid, otherwise the file is scanned for lines
+    which are neither empty nor comments
+    """
+    if lwarchive.is_archive(filename):
+        return lwarchive.Archive(filename).rows
+    cached = read_cache(filename)
+    if cached is not None:
+        return cached[0].shape[0]
+
+    rows = 0
+    with open(filename, 'rb') as filep:
+        for _ in range(HEADER_ROWS):
+            filep.readline()
+        # a row starts after every newline, so the previous byte is carried over
+        prev = b'\n'
+        chunk = filep.read(1 << 22)
+        while chunk:
+            text = np.frombuffer(prev + chunk, dtype=np.uint8)
+            first = text[1:][text[:-1] == ord('\n')]
+            rows += np.count_nonzero((first != ord('#')) & (first != ord('\n')) &
+                                     (first != ord('\r')))
+            prev = chunk[-1:]
+            chunk = filep.read(1 << 22)
+    return rows
+
+
+def load_columns(filename, cache=True):
+    """
+    returns the raw (N, 8) columns and the header metadata dict of an ldump file
+    if cache is True, a valid sidecar (filename + CACHE_SUFFIX) is memory mapped
+    instead of parsing the text, and a missing or stale sidecar is rewritten
+    lwarchive archives are read directly and never cached
+    """
+    if lwarchive.is_archive(filename):
+        archive = lwarchive.Archive(filename)
+        meta = {'wave_samp_per': archive.wave_samp_per, 'yscale': archive.yscale}
+        return archive.read(), meta
+
+    if cache:
+        cached = read_cache(filename)
+        if cached is not None:
+            return cached
+
+    # stamped before parsing: a capture still being written mustn't get the stamp
+    # of rows it has but data doesn't
+    stamp = _source_stamp(filename)
+    wave_samp_per, yscale = read_header(filename)
+    meta = {'wave_samp_per': wave_samp_per, 'yscale': yscale}
+    data = read_columns(filename)
+
+    if cache and _source_stamp(filename) == stamp:
+        try:
+            write_cache(filename, data, meta, stamp)
+        except (IOError, OSError):
+            # read only capture directories just don't get a cache
+            pass
+    return data, meta
+
+
+def _source_stamp(filename):
+    """ returns the (size, mtime) pair a cache is validated against """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+def write_cache(filename, data, meta, stamp=None):
+    """
+    writes data (N, 8) and meta to the sidecar of filename
+    the sidecar is a CACHE_HEADER_SIZE byte json header followed by float64 rows
+    stamp is the (size, mtime) of filename when data was read, now if not given
+    """
+    size, mtime = stamp or _source_stamp(filename)
+    header = dict(meta, size=size, mtime=mtime, rows=data.shape[0])
+    header = CACHE_MAGIC + json.dumps(header).encode()
+    assert len(header) < CACHE_HEADER_SIZE, "cache header too long"
+
+    cache_name = filename + CACHE_SUFFIX
+    # a temporary file of our own, so concurrent loaders don't write over each other
+    # and the sidecar is replaced in one step
+    fd, tmp_name = tempfile.mkstemp(prefix=os.path.basename(cache_name),
+                                    dir=os.path.dirname(os.path.abspath(cache_name)))
+    try:
+        with os.fdopen(fd, 'wb') as filep:
+            filep.write(header.ljust(CACHE_HEADER_SIZE, b'\0'))
+            np.ascontiguousarray(data, dtype=np.float64).tofile(filep)
+        os.replace(tmp_name, cache_name)
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+
+
+def read_cache(filename):
+    """
+    returns (data, meta) memory mapped from the sidecar of filename
+    returns None if there is no sidecar or it doesn't match the source size and mtime
+    """
+    cache_name = filename + CACHE_SUFFIX
+    try:
+        with open(cache_name, 'rb') as filep:
+            header = filep.read(CACHE_HEADER_SIZE)
+    except (IOError, OSError):
+        return None
+
+    if not header.startswith(CACHE_MAGIC):
+        return None
+    meta = json.loads(header[len(CACHE_MAGIC):].rstrip(b'\0').decode())
+    if (meta.pop('size'), meta.pop('mtime')) != _source_stamp(filename):
+        return None
+
+    rows = meta.pop('rows')
+    if rows == 0:
+        return np.empty((0, COLUMNS)), meta
+    data = np.memmap(cache_name, dtype=np.float64, mode='r',
+                     offset=CACHE_HEADER_SIZE, shape=(rows, COLUMNS))
+    return data, meta
+
+
+def iter_columns(filename, block_rows=BLOCK_ROWS):
+    """
+    yields the raw columns of an ldump file as (block_rows, 8) np.ndarrays
+    only the last block may be shorter. A valid cache sidecar is read instead of
+    the text file when there is one. lwarchive archives are read chunk by chunk
+    """
+    if lwarchive.is_archive(filename):
+        archive = lwarchive.Archive(filename)
+        for start in range(0, archive.rows, block_rows):
+            yield archive.read(start, start + block_rows)
+        return
+
+    cached = read_cache(filename)
+    if cached is not None:
+        data = cached[0]
+        for start in range(0, data.shape[0], block_rows):
+            yield np.array(data[start:start + block_rows])
+        return
+
+    reader = pd.read_csv(filename, skiprows=HEADER_ROWS, sep=' ', names=range(
+        COLUMNS), na_values='#', dtype=np.float64, engine='c', chunksize=block_rows)
+
+    # comment rows are dropped per chunk, so chunks are re-cut to block_rows here
+    pending = []
+    pending_rows = 0
+    for chunk in reader:
+        pending.append(chunk.dropna().values)
+        pending_rows += pending[-1].shape[0]
+        if pending_rows < block_rows:
+            continue
+        data = np.concatenate(pending)
+        whole = data.shape[0] - data.shape[0] % block_rows
+        for start in range(0, whole, block_rows):
+            yield data[start:start + block_rows]
+        pending = [data[whole:]]
+        pending_rows = pending[0].shape[0]
+
+    if pending_rows:
+        yield np.concatenate(pending)
+
+
+def iter_parse(filename, yscale, avrfac, block_rows=BLOCK_ROWS, dtype=DTYPE):
+    """
+    streaming version of parse, memory use is bounded by block_rows
+    yields dicts with 'raw' (complex), 'abs' and 'avr' (n, 4) np.ndarrays, one
+    column per board. 'avr' is continuous across blocks, so concatenating the
+    blocks gives the same result as parse
+    """
+    avr = MovingMean(avrfac)
+    for data in iter_columns(filename, block_rows):
+        raw_data = scale_raw(data[:, 0::2], data[:, 1::2], yscale, dtype)
+        abs_data = abs(raw_data)
+        yield {'raw': raw_data, 'abs': abs_data, 'avr': avr.update(abs_data)}
+
+
+class TailReader(object):
+    """
+    reads the rows appended to an ldump file which is still being written
+    each read() parses only the complete lines written since the previous read
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.rows = 0
+        self.reset()
+
+    def reset(self):
+        """ starts again from the first data row, eg. after the file was truncated """
+        with open(self.filename, 'rb') as filep:
+            for _ in range(HEADER_ROWS):
+                filep.readline()
+            self.offset = filep.tell()
+        self.rows = 0
+
+    def truncated(self):
+        """ returns True if the file is now shorter than what has been read """
+        return os.path.getsize(self.filename) < self.offset
+
+    def read(self):
+        """ returns the (n, 8) raw columns of the new complete rows, n may be 0 """
+        with open(self.filename, 'rb') as filep:
+            filep.seek(self.offset)
+            text = filep.read()
+        # a partly written last line is left for the next read
+        end = text.rfind(b'\n') + 1
+        if not end:
+            return np.empty((0, COLUMNS))
+        self.offset += end
+        if not text[:end].strip():
+            return np.empty((0, COLUMNS))
+        data = read_columns(io.BytesIO(text[:end]), skiprows=0)
+        self.rows += data.shape[0]
+        return data
+
+
+class PhaseTracker(object):
+    """
+    unwrapped phase of a stream of (n, boards) complex blocks
+    LdumpData measures phase relative to the phase of the mean of the whole capture;
+    a stream has no final mean, so the mean of the first block is used. That only
+    shifts the phase by a constant
+    """
+
+    def __init__(self):
+        self.reference = None
+        self.last_angle = None
+        self.last_phase = None
+
+    def update(self, raw):
+        """ returns the unwrapped phase of the rows of raw, continuous with before """
+        if not raw.shape[0]:
+            return np.empty(raw.shape)
+        if self.reference is None:
+            self.reference = np.angle(raw.mean(axis=0, dtype=np.complex128)).astype(
+                np.finfo(raw.dtype).dtype)
+        angle = np.angle(raw) - self.reference
+        if self.last_angle is None:
+            phase = np.unwrap(angle, axis=0)
+        else:
+            # unwrap from the last wrapped angle, then continue from the last phase
+            phase = np.unwrap(np.vstack((self.last_angle, angle)), axis=0)
+            phase = phase[1:] - phase[0] + self.last_phase
+        self.last_angle = angle[-1]
+        self.last_phase = phase[-1]
+        return phase
+
+
+class MovingMean(object):
     """
-    parse ldump file to a lib object containing raw data (complex), absolute values
-    of data and a moving average with window of avrfac. Data is scaled using yscale
+    rolling mean over a stream of blocks
+    the last window - 1 rows are carried between blocks, so the first window - 1
+    rows of the stream are NaN just like moving_mean over the whole array
     """
-    data = pd.read_csv(filename, skiprows=4, sep=' ', names=range(
-        8), na_values='#', dtype=np.float, engine='c')
-    data = data.dropna()
 
-    raw_data = np.empty(4, dtype=np.ndarray)
-    abs_data = np.empty(4, dtype=np.ndarray)
-    avr_data = np.empty(4, dtype=np.ndarray)
-    for i in range(4):
-        # convert to complex np array
-        raw_data[i] = (np.array(data[i * 2]) +
-                       1j * np.array(data[i * 2 + 1])) / yscale
-        abs_data[i] = abs(raw_data[i])
-        avr_data[i] = moving_mean(abs_data[i], avrfac)
-    return {'raw': raw_data, 'abs': abs_data, 'avr': avr_data}
+    def __init__(self, window):
+        self.window = window
+        self.tail = None
+
+    def update(self, block):
+        """ returns the rolling mean (along axis 0) for the rows of block """
+        block = np.asarray(block)
+        data = block if self.tail is None else np.concatenate((self.tail, block))
+        self.tail = data[max(data.shape[0] - (self.window - 1), 0):].copy()
+
+        return moving_mean(data, self.window)[data.shape[0] - block.shape[0]:]
 
 
 def moving_mean(arr, window):
-    """ returns the rolling mean of arr as a np.ndarray """
+    """
+    returns the rolling mean of arr along axis 0 as a np.ndarray
+    arr may be (N,) or (N, boards), every column is averaged in the same pass
+    the first window - 1 rows are NaN, like pandas rolling(window).mean()
+    float32 arr gives a float32 mean, but the sums are always float64
+    """
     assert isinstance(
         arr, np.ndarray), "arr type must be np.ndarray not {}".format(arr.dtype)
-    if pd.__version__ >= '0.18.0':
-        return np.array(pd.Series(arr).rolling(window=window, center=False).mean())
-    else:
-        return np.array(pd.rolling_mean(arr, window))
+    rows = arr.shape[0]
+    avr = np.full(arr.shape, np.nan, dtype=np.result_type(arr.dtype, np.float32))
+
+    # window sums are differences of cumulative sums. The sums are restarted every
+    # chunk, relative to the first value of the chunk, so rounding error stays
+    # bounded by the chunk length rather than growing with the capture length
+    chunk = max(BLOCK_ROWS, 4 * window)
+    for start in range(window - 1, rows, chunk):
+        stop = min(start + chunk, rows)
+        seg = arr[start - window + 1:stop]
+        offset = seg[0].astype(np.float64)
+        csum = np.zeros((seg.shape[0] + 1,) + seg.shape[1:])
+        np.cumsum(seg - offset, axis=0, out=csum[1:])
+        avr[start:stop] = (csum[window:] - csum[:-window]) / window + offset
+    return avr
@@ -3,13 +3,28 @@ provides various functions for plotting longwave data
 """
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
 
+import lwraster
+import lwspectrum
+import stagetimer
+
+# spectra with fewer bins than this are plotted without reduction
+FFT_REDUCE_MIN = 1 << 16
+
+# buckets averaging at least this many samples are reduced one at a time: the per
+# bucket overhead is then less than the extra passes of the segmented reductions
+LOOP_BUCKET = 4096
+
+# I/Q plots with more points than this are drawn as a DENSITY_BINS square image
+DENSITY_POINTS = 200000
+DENSITY_BINS = 400
+
+@stagetimer.timed('reduce')
 def xyreduce(x, y, sample='lin', factor=16384):
     """
     reduces array by a factor of ~groupsize/3 by taking the min, max and mean of each
     group. The groupsizes can be constant or logaritmic based on 'sample'
-    returns reduced ndarrays
+    returns reduced ndarrays of the dtypes of x and y (means are summed in float64)
     """
     assert x.size == y.size, 'arrays must have same length, {}, {}'.format(
         x.size, y.size)
@@ -17,53 +32,143 @@ def xyreduce(x, y, sample='lin', factor=16384):
     samples = y.size // factor
     assert samples > 0, 'factor must be less than array size. factor: {}, array: {}'.format(
         factor, y.size)
-    new_size = samples * per_sample
 
     assert sample == 'lin' or sample == 'log', 'sample must be either \'lin\' or \'log\''
 
-    if sample == 'lin':
-        idx = np.arange(0, y.size + factor, factor)
+    if sample == 'lin' and factor >= LOOP_BUCKET:
+        reduced = _reduce_loop(x, y, np.arange(samples + 1) * factor)
+    elif sample == 'lin':
+        reduced = _reduce_lin(x, y, samples, factor)
     else:
         idx = np.logspace(0, np.log10(y.size), samples + 1).astype(np.int_)
+        if y.size >= LOOP_BUCKET * samples:
+            reduced = _reduce_loop(x, y, idx)
+        else:
+            reduced = _reduce_segments(x, y, idx)
 
-    new_x = np.empty(new_size, dtype=x.dtype)
-    new_y = np.empty(new_size, dtype=y.dtype)
+    x_min, x_mean, x_max, y_min, y_mean, y_max = reduced
+    new_x = np.empty((samples, per_sample), dtype=x.dtype)
+    new_y = np.empty((samples, per_sample), dtype=y.dtype)
+    new_x[:, 0], new_x[:, 1], new_x[:, 2] = x_min, x_mean, x_max
+    new_y[:, 0], new_y[:, 1], new_y[:, 2] = y_min, y_mean, y_max
+
+    return new_x.ravel(), new_y.ravel()
 
-    assert isinstance(samples, int), "samples is {}, a {}".format(samples, type(samples))
-    for i in range(samples):
-        low = idx[i]
-        high = idx[i + 1]
-        if high == low:
-            high += 1
 
+def _reduce_loop(x, y, idx):
+    """
+    like _reduce_segments, one group at a time. Faster when there are few, large
+    groups: each is reduced while it is in cache
+    """
+    reduced = [np.empty(idx.size - 1, dtype=arr.dtype) for arr in (x, x, x, y, y, y)]
+    x_min, x_mean, x_max, y_min, y_mean, y_max = reduced
+    for i in range(idx.size - 1):
+        low = idx[i]
+        high = max(idx[i + 1], low + 1)
         x_slice = x[low:high]
         y_slice = y[low:high]
+        at_min = y_slice.argmin()
+        at_max = y_slice.argmax()
+        x_min[i], x_max[i] = x_slice[at_min], x_slice[at_max]
+        y_min[i], y_max[i] = y_slice[at_min], y_slice[at_max]
+        x_mean[i] = x_slice.mean(dtype=np.float64)
+        y_mean[i] = y_slice.mean(dtype=np.float64)
+    return reduced
 
-        new_x[i * per_sample: (i + 1) * per_sample] = [x_slice[y_slice.argmin()],
-                                                       x_slice.mean(), x_slice[y_slice.argmax()]]
-        new_y[i * per_sample: (i + 1) * per_sample] = [y_slice.min(),
-                                                       y_slice.mean(), y_slice.max()]
 
-    return new_x, new_y
+def _reduce_lin(x, y, samples, factor):
+    """
+    returns x at min, x mean, x at max, y min, y mean and y max of each of the
+    samples consecutive groups of factor elements (the remainder is dropped)
+    """
+    size = samples * factor
+    x_groups = x[:size].reshape(samples, factor)
+    y_groups = y[:size].reshape(samples, factor)
+    rows = np.arange(samples)
+
+    return (x_groups[rows, y_groups.argmin(axis=1)],
+            x_groups.mean(axis=1, dtype=np.float64),
+            x_groups[rows, y_groups.argmax(axis=1)], y_groups.min(axis=1),
+            y_groups.mean(axis=1, dtype=np.float64), y_groups.max(axis=1))
+
+
+def _reduce_segments(x, y, idx):
+    """
+    like _reduce_lin for the groups x[idx[i]:idx[i + 1]]
+    idx must be non decreasing. A group with idx[i] == idx[i + 1] (a duplicate edge
+    from log spacing) holds the single element at idx[i]
+    """
+    starts = idx[:-1]
+    single = idx[1:] == starts
+    reduced = [np.empty(starts.size, dtype=arr.dtype) for arr in (x, x, x, y, y, y)]
+
+    # duplicate edges are single element groups, every reduction is that element
+    at = np.minimum(starts[single], y.size - 1)
+    for out, arr in zip(reduced, (x, x, x, y, y, y)):
+        out[single] = arr[at]
+
+    # the remaining groups are disjoint and cover idx[0]:idx[-1] without gaps
+    wide = ~single
+    if not wide.any():
+        return reduced
+    low, high = idx[0], idx[-1]
+    x_seg = x[low:high]
+    y_seg = y[low:high]
+    offsets = starts[wide] - low
+    counts = np.diff(np.append(offsets, high - low))
+
+    y_min = np.minimum.reduceat(y_seg, offsets)
+    y_max = np.maximum.reduceat(y_seg, offsets)
+    reduced[0][wide] = x_seg[_segment_first(y_seg, y_min, offsets, counts)]
+    reduced[1][wide] = np.add.reduceat(x_seg, offsets, dtype=np.float64) / counts
+    reduced[2][wide] = x_seg[_segment_first(y_seg, y_max, offsets, counts)]
+    reduced[3][wide] = y_min
+    reduced[4][wide] = np.add.reduceat(y_seg, offsets, dtype=np.float64) / counts
+    reduced[5][wide] = y_max
+    return reduced
+
+
+def _segment_first(arr, values, offsets, counts):
+    """
+    returns the index into arr of the first element of each segment equal to the
+    segment's entry in values (NaN matches NaN, like argmin and argmax)
+    """
+    expected = np.repeat(values, counts)
+    hit = arr == expected
+    nan_segments = np.flatnonzero(np.isnan(values))
+    if nan_segments.size:
+        # only the segments holding NaNs need the slower NaN matching
+        low = offsets[nan_segments[0]]
+        high = offsets[nan_segments[-1]] + counts[nan_segments[-1]]
+        hit[low:high] |= np.isnan(arr[low:high]) & np.isnan(expected[low:high])
+    # hits are sorted, so the first hit of a segment is where the segment changes
+    position = np.flatnonzero(hit)
+    segment = np.searchsorted(offsets, position, 'right')
+    first = np.ones(position.size, dtype=bool)
+    first[1:] = segment[1:] != segment[:-1]
+    return position[first]
 
 
 def plot(ax, x, y, reduced, *args):
-    """ plots x and y on axis x with args"""
-    if reduced:
+    """
+    plots x and y on axis x with args
+    lwraster panels draw a min/max envelope per pixel column, so they skip xyreduce
+    """
+    if reduced and not isinstance(ax, lwraster.Panel):
         x, y = xyreduce(x, y)
     ax.plot(x, y, *args)
 
 
 def loglog(ax, x, y, reduced, *args):
     """ plots x and y on axis x with args"""
-    if reduced:
+    if reduced and not isinstance(ax, lwraster.Panel):
         x, y = xyreduce(x, y, 'log')
     ax.loglog(x, y, *args)
 
 
 def semilogx(ax, x, y, reduced, *args):
     """ plots x and y on axis x with args"""
-    if reduced:
+    if reduced and not isinstance(ax, lwraster.Panel):
         x, y = xyreduce(x, y, 'log')
     ax.semilogx(x, y, *args)
     # ax.tick_params(axis='y',
@@ -73,11 +178,154 @@ def semilogx(ax, x, y, reduced, *args):
     #                labelsize='large')
 
 
+class StreamReducer(object):
+    """
+    xyreduce ('lin') of a stream of (x, y) blocks. Every factor samples become a
+    min/mean/max triple, the samples of an unfinished group are carried over, so
+    after any number of updates x and y hold what xyreduce would give for all of
+    the samples so far
+    """
+
+    def __init__(self, factor=16384):
+        self.factor = factor
+        self.carry_x = np.empty(0)
+        self.carry_y = np.empty(0)
+        self.reduced_x = []
+        self.reduced_y = []
+
+    def update(self, x, y):
+        """ adds the samples x, y """
+        x = np.concatenate((self.carry_x, x))
+        y = np.concatenate((self.carry_y, y))
+        samples = y.size // self.factor
+        if samples:
+            x_min, x_mean, x_max, y_min, y_mean, y_max = _reduce_lin(x, y, samples,
+                                                                     self.factor)
+            self.reduced_x.append(np.column_stack((x_min, x_mean, x_max)).ravel())
+            self.reduced_y.append(np.column_stack((y_min, y_mean, y_max)).ravel())
+        used = samples * self.factor
+        self.carry_x = x[used:]
+        self.carry_y = y[used:]
+
+    @property
+    def x(self):
+        """ reduced x so far """
+        if len(self.reduced_x) != 1:
+            self.reduced_x = [np.concatenate([np.empty(0)] + self.reduced_x)]
+        return self.reduced_x[0]
+
+    @property
+    def y(self):
+        """ reduced y so far """
+        if len(self.reduced_y) != 1:
+            self.reduced_y = [np.concatenate([np.empty(0)] + self.reduced_y)]
+        return self.reduced_y[0]
+
+
+class LodPyramid(object):
+    """
+    precomputed min/mean/max level of detail pyramid of y(x) for zooming through
+    long captures. Level 0 is the data itself, level k reduces groups of step**k
+    samples with the same min/mean/max scheme as xyreduce. x must be increasing
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        data to reduce
+
+    step : int, optional
+        number of buckets of a level combined into one bucket of the next level
+
+    min_buckets : int, optional
+        levels stop once they have fewer buckets than this
+
+    Returns
+    -------
+    LodPyramid object
+    """
+    def __init__(self, x, y, step=4, min_buckets=1024):
+        assert x.size == y.size, 'arrays must have same length, {}, {}'.format(
+            x.size, y.size)
+        self.x = x
+        self.y = y
+        self.step = step
+
+        # each level is (x_min, x_mean, x_max, y_min, y_mean, y_max, counts)
+        edges = np.append(np.arange(0, y.size, step), y.size)
+        level = _reduce_segments(x, y, edges) + [np.diff(edges)]
+        self.levels = [level]
+        while level[0].size > min_buckets:
+            level = _combine_level(level, step)
+            self.levels.append(level)
+
+    def visible(self, xlo, xhi, pixels):
+        """
+        returns (x, y) to draw for the x range [xlo, xhi] on an axis pixels wide
+        the coarsest level still giving about a bucket per pixel is used, and only
+        the buckets overlapping the range (plus one either side) are returned
+        """
+        low = max(np.searchsorted(self.x, xlo, 'left') - 1, 0)
+        high = min(np.searchsorted(self.x, xhi, 'right') + 1, self.y.size)
+        per_pixel = (high - low) / max(float(pixels), 1.0)
+        if per_pixel <= self.step:
+            return self.x[low:high], self.y[low:high]
+
+        # level k has buckets of step**(k + 1) samples
+        k = min(int(np.log(per_pixel) / np.log(self.step)) - 1, len(self.levels) - 1)
+        size = self.step ** (k + 1)
+        first = low // size
+        last = -(-high // size)
+        x_min, x_mean, x_max, y_min, y_mean, y_max = [
+            arr[first:last] for arr in self.levels[k][:6]]
+        return (np.column_stack((x_min, x_mean, x_max)).ravel(),
+                np.column_stack((y_min, y_mean, y_max)).ravel())
+
+
+def _combine_level(level, step):
+    """ returns the pyramid level made by merging every step buckets of level """
+    x_min, x_mean, x_max, y_min, y_mean, y_max, counts = level
+    offsets = np.arange(0, counts.size, step)
+    groups = np.diff(np.append(offsets, counts.size))
+
+    new_y_min = np.minimum.reduceat(y_min, offsets)
+    new_y_max = np.maximum.reduceat(y_max, offsets)
+    new_counts = np.add.reduceat(counts, offsets)
+    return [x_min[_segment_first(y_min, new_y_min, offsets, groups)],
+            np.add.reduceat(x_mean * counts, offsets) / new_counts,
+            x_max[_segment_first(y_max, new_y_max, offsets, groups)],
+            new_y_min,
+            np.add.reduceat(y_mean * counts, offsets) / new_counts,
+            new_y_max,
+            new_counts]
+
+
+def plot_lod(ax, pyramid, *args):
+    """
+    plots a LodPyramid on axis ax with args and redraws the visible slice at a
+    matching level of detail every time the x limits change
+    returns the Line2D
+    """
+    def visible():
+        xlo, xhi = ax.get_xlim()
+        return pyramid.visible(xlo, xhi, ax.bbox.width)
+
+    line, = ax.plot(*pyramid.visible(pyramid.x[0], pyramid.x[-1], ax.bbox.width) + args)
+
+    def update(_):
+        line.set_data(*visible())
+        ax.figure.canvas.draw_idle()
+
+    # a plain function (not a bound method) so the callback registry keeps it alive
+    ax.callbacks.connect('xlim_changed', update)
+    return line
+
+
 def plot_fft(ax1, x, y, dsize, reduce):
-    """ plots data for middle graphs"""
+    """ plots data for middle graphs, the raw abs(fft) of y (not a density) """
     # y = y * np.hanning(dsize)
     # y = y[dsize-y.size:] * np.hanning(dsize)[dsize-y.size:]
-    fft = abs(np.fft.fft(y))[:dsize//2]
+    fft = np.sqrt(lwspectrum.welch(y, window_name=None, onesided=False,
+                                   scaling=None))[:dsize//2]
     loglog(ax1, x[:dsize//2], fft, reduce)
 
     # ax1.tick_params('y', colors='b')
@@ -85,19 +333,38 @@ def plot_fft(ax1, x, y, dsize, reduce):
     # semilogx(ax2, x[:size], np.sqrt(np.cumsum((fft)**2)), reduce, 'r')
     # ax2.tick_params('y', colors='r')
 
-def nplot_fft(ax1, faxis, raw_data, reduce):
-    size = raw_data.size//2
-    fft = abs(np.fft.fft(raw_data * np.hanning(raw_data.size)))[:size]
-    # fft = abs(np.fft.fft(raw_data))[:size]
-    loglog(ax1, faxis[:size], fft, reduce)
+def nplot_fft(ax1, faxis, raw_data, reduce, nperseg=None):
+    """
+    plots the hanning windowed spectral density of raw_data and its integral (red,
+    right axis). faxis is the frequency axis of a full length fft. If nperseg is
+    given the spectrum is Welch averaged over half overlapping segments of nperseg
+    samples
+    """
+    fs = faxis[1] * raw_data.size
+    power = lwspectrum.welch(raw_data, nperseg, fs=fs)
+    # segment bins are raw_data.size / nperseg full length bins apart
+    fstep = fs / (nperseg or raw_data.size)
+    plot_spectrum(ax1, np.arange(power.size) * fstep, power, reduce)
+
+
+def plot_spectrum(ax1, freqs, power, reduce):
+    """
+    plots sqrt(power) against freqs and the integrated noise
+    sqrt(cumsum(power) * bin width) on a twin axis (red). power is a spectral
+    density from lwspectrum.welch, so neither depends on the segment length
+    """
+    # short Welch spectra are cheap to draw and too short for xyreduce's log buckets
+    reduce = reduce and power.size >= FFT_REDUCE_MIN
+    fft = np.sqrt(power)
+    loglog(ax1, freqs, fft, reduce)
 
     # plot integral
     ax2 = ax1.twinx()
-    semilogx(ax2, faxis[:size], np.sqrt(np.cumsum((fft)**2)), reduce, 'r')
+    semilogx(ax2, freqs, np.sqrt(np.cumsum(power) * (freqs[1] - freqs[0])), reduce, 'r')
     # ax2.tick_params('raw_data', colors='r')
 
-    xlo, xhi = plt.xlim()
-    plt.xlim([10**-1, xhi])
+    xlo, xhi = ax2.get_xlim()
+    ax2.set_xlim([10**-1, xhi])
 
 # def nplot_fft(ax1, faxis, raw_data, reduce):
 #     size = raw_data.size//2
@@ -115,9 +382,24 @@ def nplot_fft(ax1, faxis, raw_data, reduce):
 #     plt.xlim([10**-1, xhi])
 
 
+def plot_spectrogram(ax, times, freqs, power):
+    """
+    draws a spectrogram, power (times, bins) from lwspectrum.spectrogram, as a
+    single image in dB against time (x) and frequency (y)
+    """
+    with np.errstate(divide='ignore'):
+        image = 10 * np.log10(power.T)
+    ax.imshow(image, cmap='jet', origin='lower', aspect='auto', interpolation='nearest',
+              extent=[times[0], times[-1], freqs[0], freqs[-1]])
+
+
 # TODO: use reduce on x and y (remember to turn of sample step)
 def plot_bottom(ax, z, heatmap, *args):
-    """ plots data for bottom graphs"""
+    """
+    plots data for bottom graphs
+    above DENSITY_POINTS points the cloud is drawn as a density image (plot_density)
+    instead of one marker per point
+    """
     if heatmap:
         plot_heatmap(ax, z.real, z.imag)
     else:
@@ -125,16 +407,40 @@ def plot_bottom(ax, z, heatmap, *args):
         # x1, y1 = xyreduce(x, y, 'lin', 4096)
         # y2, x2 = xyreduce(y, x, 'lin', 4096)
         # ax.plot(np.append(x1, x2), np.append(y1, y2), *args)
-        theta = np.angle(z.mean())
-        z = z * np.exp(-1j * theta)
+        theta = np.angle(z.mean(dtype=np.complex128))
+        # rotate in the precision of z, complex64 stays complex64
+        z = z * np.exp(-1j * theta).astype(z.dtype)
         x = z.real
         y = z.imag
         width = max(x.max() - x.min(), y.max() - y.min())
         ax_width = .6 * width
-        ax.plot(x, y, *args)
+        x_mid = x.mean(dtype=np.float64)
+        y_mid = y.mean(dtype=np.float64)
+        if x.size > DENSITY_POINTS and ax_width > 0:
+            plot_density(ax, x, y, [x_mid - ax_width, x_mid + ax_width,
+                                    y_mid - ax_width, y_mid + ax_width])
+        else:
+            ax.plot(x, y, *args)
+
+        ax.set_xlim([x_mid - ax_width, x_mid + ax_width])
+        ax.set_ylim([y_mid - ax_width, y_mid + ax_width]) #set plt ranges
 
-        plt.xlim([x.mean() - ax_width, x.mean() + ax_width])
-        plt.ylim([y.mean() - ax_width, y.mean() + ax_width]) #set plt ranges
+
+def plot_density(ax, x, y, extent, bins=DENSITY_BINS):
+    """
+    draws the number of points of x, y falling in each of bins x bins pixels of
+    extent [xlo, xhi, ylo, yhi] as a single image. empty pixels are left blank
+    """
+    xlo, xhi, ylo, yhi = extent
+    col = (x - xlo) * (bins / float(xhi - xlo))
+    row = (y - ylo) * (bins / float(yhi - ylo))
+    inside = (col >= 0) & (col < bins) & (row >= 0) & (row < bins)
+    pixel = row[inside].astype(np.intp) * bins + col[inside].astype(np.intp)
+    density = np.bincount(pixel, minlength=bins * bins).reshape(bins, bins).astype(float)
+    density[density == 0] = np.nan
+
+    ax.imshow(density, cmap='jet', extent=extent, origin='lower', aspect='auto',
+              interpolation='nearest')
 
 
 def plot_heatmap(ax, x, y):
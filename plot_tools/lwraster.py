@@ -0,0 +1,530 @@
+"""
+rasterizes trace panels straight into RGB pixel arrays with numpy, for fast batch
+reports without matplotlib
+
+a Panel stands in for the few matplotlib Axes methods lwplot and lwmain use
+(plot, loglog, semilogx, twinx, imshow, set_xlim, set_title, ...). Lines with
+increasing x are drawn as the min/max of every pixel column, so a trace costs one
+pass over its samples however long it is and doesn't need xyreduce. Grid lays
+panels out like a matplotlib figure and writes the PNG with zlib. Titles, labels
+and tick values use a small built-in bitmap font
+"""
+import struct
+import zlib
+import numpy as np
+
+PANEL_WIDTH = 720
+PANEL_HEIGHT = 450
+# pixels around the plot area of a panel: left, right, top, bottom
+MARGINS = (100, 100, 30, 50)
+TITLE_HEIGHT = 40
+FONT_SCALE = 2
+TICKS = 5
+BLACK = (0, 0, 0)
+
+COLORS = {'b': (0, 0, 255), 'g': (0, 128, 0), 'r': (255, 0, 0), 'c': (0, 191, 191),
+          'm': (191, 0, 191), 'y': (191, 191, 0), 'k': (0, 0, 0), 'w': (255, 255, 255)}
+# matplotlib's default colour cycle, used for lines given no colour
+CYCLE = [(31, 119, 180), (255, 127, 14), (44, 160, 44), (214, 39, 40)]
+MARKERS = '.,o'
+
+# matplotlib's jet colormap as (position, value) breakpoints of red, green and blue
+JET = [((0, 0.35, 0.66, 0.89, 1), (0, 0, 1, 1, 0.5)),
+       ((0, 0.125, 0.375, 0.64, 0.91, 1), (0, 0, 1, 1, 0, 0)),
+       ((0, 0.11, 0.34, 0.65, 1), (0.5, 1, 1, 0, 0))]
+
+# 3x5 glyphs, one octal digit per row with the most significant bit on the left
+GLYPHS = {
+    '0': '75557', '1': '26227', '2': '71747', '3': '71717', '4': '55711',
+    '5': '74717', '6': '74757', '7': '71111', '8': '75757', '9': '75717',
+    'A': '25755', 'B': '65656', 'C': '34443', 'D': '65556', 'E': '74647',
+    'F': '74644', 'G': '34553', 'H': '55755', 'I': '72227', 'J': '11152',
+    'K': '55655', 'L': '44447', 'M': '57755', 'N': '65555', 'O': '25552',
+    'P': '65644', 'Q': '25563', 'R': '65655', 'S': '34216', 'T': '72222',
+    'U': '55557', 'V': '55552', 'W': '55775', 'X': '55255', 'Y': '55222',
+    'Z': '71247', ' ': '00000', '.': '00002', ',': '00024', ':': '02020',
+    '-': '00700', '+': '02720', '(': '12221', ')': '42224', '%': '51245',
+    '/': '11244', '_': '00007', '|': '22222', '?': '71202',
+}
+
+
+class Panel(object):
+    """
+    pixel panel with the subset of the matplotlib Axes interface used by lwplot
+    drawing is deferred to render, so limits set after plotting (as
+    lwplot.plot_spectrum does) apply to everything
+
+    Parameters
+    ----------
+    width, height : int, optional
+        size of the panel in pixels, margins included
+
+    parent : Panel, optional
+        the panel a twinx panel shares its x axis and pixels with
+
+    Returns
+    -------
+    Panel object
+    """
+    def __init__(self, width=PANEL_WIDTH, height=PANEL_HEIGHT, parent=None):
+        self.width = width
+        self.height = height
+        self.parent = parent
+        self.twins = []
+        self.artists = []
+        self.title = ''
+        self.xlabel = ''
+        self.ylabel = ''
+        self.xlim = None
+        self.ylim = None
+        self.xscale = 'linear'
+        self.yscale = 'linear'
+        self.colors = 0
+
+    def _root(self):
+        """ returns the panel owning the x axis """
+        return self.parent or self
+
+    def plot(self, x, y, fmt=''):
+        """ adds the line (or markers if fmt has one of MARKERS) y against x """
+        color = None
+        for char in fmt:
+            if char in COLORS:
+                color = COLORS[char]
+        if color is None:
+            color = CYCLE[self.colors % len(CYCLE)]
+            self.colors += 1
+        markers = any(char in MARKERS for char in fmt)
+        self.artists.append(('line', np.asarray(x, dtype=np.float64),
+                             np.asarray(y, dtype=np.float64), color, markers))
+
+    def loglog(self, x, y, fmt=''):
+        """ plot on log x and y axes """
+        self.set_xscale('log')
+        self.yscale = 'log'
+        self.plot(x, y, fmt)
+
+    def semilogx(self, x, y, fmt=''):
+        """ plot on a log x axis """
+        self.set_xscale('log')
+        self.plot(x, y, fmt)
+
+    def imshow(self, image, cmap='jet', extent=None, origin='upper', **kwargs):
+        """
+        adds image coloured with cmap (only 'jet') over extent [xlo, xhi, ylo, yhi]
+        NaN pixels are left blank. like interpolation='nearest', other matplotlib
+        keywords are ignored
+        """
+        assert cmap == 'jet', 'only the jet colormap is supported'
+        image = np.asarray(image, dtype=np.float64)
+        if extent is None:
+            extent = [-0.5, image.shape[1] - 0.5, -0.5, image.shape[0] - 0.5]
+        if origin == 'upper':
+            image = image[::-1]
+        self.artists.append(('image', image, list(extent)))
+
+    def twinx(self):
+        """ returns a panel sharing the x axis, with its y axis on the right """
+        twin = Panel(self.width, self.height, parent=self._root())
+        self._root().twins.append(twin)
+        return twin
+
+    def set_xscale(self, scale):
+        """ sets the x scale ('linear' or 'log') of the shared x axis """
+        self._root().xscale = scale
+
+    def get_xlim(self):
+        """ returns the x limits, fitted to every line of the shared axis if not set """
+        root = self._root()
+        if root.xlim is not None:
+            return root.xlim
+        artists = [artist for panel in [root] + root.twins for artist in panel.artists]
+        return _autoscale([_extent(artist, 0) for artist in artists], root.xscale)
+
+    def set_xlim(self, left=None, right=None):
+        """ sets the x limits, given as two values or a sequence """
+        if right is None and np.iterable(left):
+            left, right = left
+        xlo, xhi = self.get_xlim()
+        self._root().xlim = (xlo if left is None else left, xhi if right is None else right)
+
+    def get_ylim(self):
+        """ returns the y limits, fitted to the panel's lines if not set """
+        if self.ylim is not None:
+            return self.ylim
+        return _autoscale([_extent(artist, 1) for artist in self.artists], self.yscale)
+
+    def set_ylim(self, bottom=None, top=None):
+        """ sets the y limits, given as two values or a sequence """
+        if top is None and np.iterable(bottom):
+            bottom, top = bottom
+        ylo, yhi = self.get_ylim()
+        self.ylim = (ylo if bottom is None else bottom, yhi if top is None else top)
+
+    def set_title(self, title):
+        """ sets the title drawn above the panel """
+        self.title = title
+
+    def set_xlabel(self, label):
+        """ sets the x axis label """
+        self.xlabel = label
+
+    def set_ylabel(self, label):
+        """ sets the y axis label """
+        self.ylabel = label
+
+    def ticklabel_format(self, **kwargs):
+        """ accepted for matplotlib compatibility, tick values are always %.3g """
+        pass
+
+    def render(self):
+        """ returns the panel as a (height, width, 3) uint8 RGB array """
+        left, right, top, bottom = MARGINS
+        pixels = np.full((self.height, self.width, 3), 255, dtype=np.uint8)
+        area = pixels[top:self.height - bottom, left:self.width - right]
+        xlim = _transform(np.array(self.get_xlim(), dtype=np.float64), self.xscale)
+        for side, panel in enumerate([self] + self.twins):
+            ylim = _transform(np.array(panel.get_ylim(), dtype=np.float64), panel.yscale)
+            for artist in panel.artists:
+                if artist[0] == 'line':
+                    _draw_line(area, artist, xlim, ylim, self.xscale, panel.yscale)
+                else:
+                    _draw_image(area, artist, xlim, ylim, self.xscale, panel.yscale)
+            panel._draw_yaxis(pixels, ylim, side > 0)
+        self._draw_xaxis(pixels, xlim)
+
+        # frame
+        pixels[top - 1, left - 1:self.width - right + 1] = BLACK
+        pixels[self.height - bottom, left - 1:self.width - right + 1] = BLACK
+        pixels[top - 1:self.height - bottom + 1, left - 1] = BLACK
+        pixels[top - 1:self.height - bottom + 1, self.width - right] = BLACK
+        _draw_text(pixels, self.title, self.width // 2, top // 2)
+        return pixels
+
+    def _draw_xaxis(self, pixels, xlim):
+        """ draws the x ticks, tick values and label below the plot area """
+        left, right, top, bottom = MARGINS
+        row = self.height - bottom
+        width = self.width - left - right
+        for value, pos in _ticks(xlim, self.xscale, width):
+            col = left + int(pos)
+            pixels[row:row + 5, col] = BLACK
+            _draw_text(pixels, _format(value), col, row + 12)
+        _draw_text(pixels, self.xlabel, self.width // 2, self.height - bottom // 4 - 4)
+
+    def _draw_yaxis(self, pixels, ylim, right_side):
+        """ draws the y ticks, tick values and label left (or right) of the area """
+        left, right, top, bottom = MARGINS
+        height = self.height - top - bottom
+        for value, pos in _ticks(ylim, self.yscale, height):
+            row = self.height - bottom - 1 - int(pos)
+            if right_side:
+                col = self.width - right
+                pixels[row, col:col + 5] = BLACK
+                _draw_text(pixels, _format(value), col + 7, row, 'left')
+            else:
+                pixels[row, left - 6:left - 1] = BLACK
+                _draw_text(pixels, _format(value), left - 8, row, 'right')
+        col = self.width - 8 if right_side else 8
+        _draw_text(pixels, self.ylabel, col, top + height // 2, rotate=True)
+
+
+class Grid(object):
+    """
+    rows x cols panels composited into one image, in place of a matplotlib figure
+
+    Parameters
+    ----------
+    rows, cols : int
+        panels down and across
+
+    width, height : int, optional
+        size of each panel in pixels
+
+    Returns
+    -------
+    Grid object
+    """
+    def __init__(self, rows, cols, width=PANEL_WIDTH, height=PANEL_HEIGHT):
+        self.rows = rows
+        self.cols = cols
+        self.panels = [Panel(width, height) for _ in range(rows * cols)]
+        self.title = ''
+
+    def add_subplot(self, rows, cols, index):
+        """ returns the panel at 1 based index, counted along rows like matplotlib """
+        assert (rows, cols) == (self.rows, self.cols), 'grid is {}x{}'.format(self.rows,
+                                                                             self.cols)
+        return self.panels[index - 1]
+
+    def suptitle(self, title):
+        """ sets the title drawn above the grid """
+        self.title = title
+
+    def image(self):
+        """ returns the grid as a (height, width, 3) uint8 RGB array """
+        tiles = [panel.render() for panel in self.panels]
+        rows = [np.concatenate(tiles[i:i + self.cols], axis=1)
+                for i in range(0, len(tiles), self.cols)]
+        band = np.full((TITLE_HEIGHT, rows[0].shape[1], 3), 255, dtype=np.uint8)
+        _draw_text(band, self.title, band.shape[1] // 2, TITLE_HEIGHT // 2)
+        return np.concatenate([band] + rows, axis=0)
+
+    def savefig(self, filename):
+        """ writes the grid to filename as a PNG """
+        write_png(filename, self.image(), {'Title': self.title})
+
+
+def write_png(filename, image, text=None, level=6):
+    """
+    writes the (height, width, 3) uint8 RGB array image to filename as a PNG,
+    with the {keyword: value} pairs of text as tEXt chunks
+    """
+    height, width, _ = image.shape
+    # every scanline starts with its filter type, 0 (none)
+    scanlines = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    scanlines[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(kind, data):
+        """ returns a PNG chunk: length, type, data and crc """
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(filename, 'wb') as filep:
+        filep.write(b'\x89PNG\r\n\x1a\n')
+        filep.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        for key, value in sorted((text or {}).items()):
+            filep.write(chunk(b'tEXt', key.encode('latin-1') + b'\0' +
+                              value.encode('latin-1', 'replace')))
+        filep.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes(), level)))
+        filep.write(chunk(b'IEND', b''))
+
+
+def jet(values):
+    """ returns the (..., 3) uint8 jet colours of values in [0, 1] """
+    values = np.clip(values, 0, 1)
+    rgb = np.stack([np.interp(values, xp, fp) for xp, fp in JET], axis=-1)
+    return np.round(255 * rgb).astype(np.uint8)
+
+
+def _transform(values, scale):
+    """ returns values on the scale's linear pixel axis (log10 for 'log') """
+    if scale != 'log':
+        return values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values > 0, np.log10(np.where(values > 0, values, 1)), np.nan)
+
+
+def _inverse(values, scale):
+    """ inverse of _transform """
+    return 10 ** values if scale == 'log' else values
+
+
+def _extent(artist, axis):
+    """ returns (values, padded) spanning artist along axis (0 for x, 1 for y) """
+    if artist[0] == 'line':
+        return artist[1 + axis], True
+    return np.array(artist[2][2 * axis:2 * axis + 2], dtype=np.float64), False
+
+
+def _autoscale(ranges, scale, margin=0.05):
+    """
+    returns limits covering every (values, padded) in ranges. padded ranges (lines)
+    get a margin like matplotlib's, images are fitted exactly
+    """
+    lows, highs = [], []
+    padded = False
+    for values, pad in ranges:
+        values = _transform(values, scale)
+        values = values[np.isfinite(values)]
+        if values.size:
+            lows.append(values.min())
+            highs.append(values.max())
+            padded = padded or pad
+    if not lows:
+        return (1.0, 10.0) if scale == 'log' else (0.0, 1.0)
+    low, high = min(lows), max(highs)
+    if high == low:
+        low, high = low - 0.5, high + 0.5
+    elif padded:
+        low, high = low - margin * (high - low), high + margin * (high - low)
+    return tuple(float(value) for value in _inverse(np.array([low, high]), scale))
+
+
+def _pixel(values, lim, size, scale, flip=False):
+    """ returns the float pixel coordinate of values on an axis size pixels long """
+    pos = (_transform(values, scale) - lim[0]) * (size / (lim[1] - lim[0]))
+    return size - pos if flip else pos
+
+
+def _draw_line(area, artist, xlim, ylim, xscale, yscale):
+    """ draws a line artist into area, the plot area pixels """
+    _, x, y, color, markers = artist
+    height, width = area.shape[:2]
+    col = _pixel(x, xlim, width, xscale)
+    row = _pixel(y, ylim, height, yscale, flip=True)
+    finite = np.isfinite(col) & np.isfinite(row)
+    if not finite.all():
+        col, row = col[finite], row[finite]
+    if not col.size:
+        return
+
+    if markers:
+        _set_points(area, col, row, color)
+    elif col.size > 1 and np.all(col[1:] >= col[:-1]):
+        low, high = _column_spans(col, row, width)
+        rows = np.arange(height)[:, np.newaxis]
+        area[(rows >= np.floor(low)) & (rows <= np.floor(high))] = color
+    else:
+        _draw_segments(area, col, row, color)
+
+
+def _column_spans(col, row, width):
+    """
+    returns the (low, high) row range the polyline through (col, row) covers in
+    each of width pixel columns (inf, -inf where it misses the column). col must be
+    non decreasing: the samples inside a column are reduced with reduceat and the
+    rows where the line crosses a column edge are interpolated
+    """
+    low = np.full(width, np.inf)
+    high = np.full(width, -np.inf)
+    cols = np.floor(col).astype(np.intp)
+    first, last = np.searchsorted(cols, [0, width])
+    if last > first:
+        cols = cols[first:last]
+        rows = row[first:last]
+        starts = np.flatnonzero(np.append(True, cols[1:] != cols[:-1]))
+        low[cols[starts]] = np.minimum.reduceat(rows, starts)
+        high[cols[starts]] = np.maximum.reduceat(rows, starts)
+
+    edges = np.arange(max(np.ceil(col[0]), 0), min(np.floor(col[-1]), width) + 1)
+    if edges.size:
+        at_edge = np.interp(edges, col, row)
+        edges = edges.astype(np.intp)
+        # an edge belongs to the columns either side of it
+        for cols, rows in ((edges - 1, at_edge), (edges, at_edge)):
+            keep = (cols >= 0) & (cols < width)
+            cols, rows = cols[keep], rows[keep]
+            low[cols] = np.minimum(low[cols], rows)
+            high[cols] = np.maximum(high[cols], rows)
+    return low, high
+
+
+def _draw_segments(area, col, row, color):
+    """
+    draws the polyline through (col, row) in any order by stepping along each
+    segment a pixel at a time. a segment takes at most as many steps as the area's
+    perimeter, so one leaving the area far behind is still cheap
+    """
+    height, width = area.shape[:2]
+    if col.size == 1:
+        _set_points(area, col, row, color)
+        return
+    dcol = np.diff(col)
+    drow = np.diff(row)
+    steps = np.minimum(np.ceil(np.maximum(abs(dcol), abs(drow))),
+                       2 * (width + height)).astype(np.intp) + 1
+    segment = np.repeat(np.arange(dcol.size), steps)
+    starts = np.repeat(np.cumsum(steps) - steps, steps)
+    frac = (np.arange(segment.size) - starts) / np.repeat(np.maximum(steps - 1, 1),
+                                                            steps).astype(np.float64)
+    _set_points(area, col[segment] + frac * dcol[segment],
+                row[segment] + frac * drow[segment], color)
+
+
+def _set_points(area, col, row, color):
+    """ sets the pixels holding the points (col, row) to color """
+    height, width = area.shape[:2]
+    cols = np.floor(col).astype(np.intp)
+    rows = np.floor(row).astype(np.intp)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    area[rows[inside], cols[inside]] = color
+
+
+def _draw_image(area, artist, xlim, ylim, xscale, yscale):
+    """ draws an image artist into area with nearest neighbour sampling """
+    _, image, extent = artist
+    height, width = area.shape[:2]
+    finite = image[np.isfinite(image)]
+    if not finite.size:
+        return
+    vmin, vmax = finite.min(), finite.max()
+    scaled = (image - vmin) / (vmax - vmin) if vmax > vmin else np.zeros_like(image)
+
+    # data coordinates of each pixel centre, then the image cell holding it
+    x = _inverse(xlim[0] + (np.arange(width) + 0.5) * ((xlim[1] - xlim[0]) / width),
+                 xscale)
+    y = _inverse(ylim[1] - (np.arange(height) + 0.5) * ((ylim[1] - ylim[0]) / height),
+                 yscale)
+    cells_x = np.floor((x - extent[0]) * (image.shape[1] / float(extent[1] - extent[0])))
+    cells_y = np.floor((y - extent[2]) * (image.shape[0] / float(extent[3] - extent[2])))
+    cols = np.flatnonzero((cells_x >= 0) & (cells_x < image.shape[1]))
+    rows = np.flatnonzero((cells_y >= 0) & (cells_y < image.shape[0]))
+    if not (cols.size and rows.size):
+        return
+    values = scaled[cells_y[rows].astype(np.intp)[:, np.newaxis],
+                    cells_x[cols].astype(np.intp)]
+    target = area[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    shown = np.isfinite(values)
+    target[shown] = jet(values[shown])
+
+
+def _ticks(lim, scale, size):
+    """
+    yields (value, pixel position) of the ticks of an axis size pixels long with
+    limits lim (already transformed): TICKS evenly spaced values, or the decades
+    of a log axis
+    """
+    low, high = sorted(lim)
+    if scale == 'log':
+        decades = np.arange(np.ceil(low), np.floor(high) + 1)
+        decades = decades[::max(1, -(-decades.size // (2 * TICKS)))]
+        positions = decades
+        values = 10 ** decades
+    else:
+        positions = values = np.linspace(low, high, TICKS)
+    for value, pos in zip(values, positions):
+        yield value, min((pos - lim[0]) * size / (lim[1] - lim[0]), size - 1)
+
+
+def _format(value):
+    """ returns the tick label of value """
+    return '{:.3g}'.format(value)
+
+
+def _text_mask(text):
+    """ returns the boolean pixel mask of text drawn in GLYPHS at FONT_SCALE """
+    if not text:
+        return np.zeros((5 * FONT_SCALE, 0), dtype=bool)
+    codes = np.array([[int(digit) for digit in GLYPHS.get(char, GLYPHS['?'])]
+                      for char in text.upper()])
+    # (chars, 5 rows, 3 bits) plus a blank column between characters
+    cells = np.zeros(codes.shape + (4,), dtype=bool)
+    cells[:, :, :3] = (codes[:, :, np.newaxis] >> np.array([2, 1, 0])) & 1
+    mask = cells.transpose(1, 0, 2).reshape(5, -1)[:, :-1]
+    return mask.repeat(FONT_SCALE, axis=0).repeat(FONT_SCALE, axis=1)
+
+
+def _draw_text(pixels, text, col, row, align='center', rotate=False, color=BLACK):
+    """
+    draws text centred vertically on row, with col at its centre, left or right
+    end as given by align. rotated text reads upwards and is centred on (col, row)
+    """
+    mask = _text_mask(text)
+    if rotate:
+        mask = np.rot90(mask)
+    height, width = mask.shape
+    top = row - height // 2
+    if align == 'center':
+        left = col - width // 2
+    elif align == 'left':
+        left = col
+    else:
+        left = col - width
+    # clip to the image
+    rows = slice(max(top, 0), min(top + height, pixels.shape[0]))
+    cols = slice(max(left, 0), min(left + width, pixels.shape[1]))
+    if rows.stop <= rows.start or cols.stop <= cols.start:
+        return
+    mask = mask[rows.start - top:rows.stop - top, cols.start - left:cols.stop - left]
+    pixels[rows, cols][mask] = color
@@ -0,0 +1,382 @@
+"""
+provides spectrum estimates of longwave data without any plotting
+"""
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# bytes of complex samples (segment rows * boards) transformed per fft call
+BATCH_BYTES = 1 << 24
+
+_WINDOWS = {}
+
+
+def window(size, name='hanning'):
+    """
+    returns the numpy window function name (eg. 'hanning', 'blackman') of size
+    samples, or ones if name is None. windows are cached and read only
+    """
+    key = (name, size)
+    if key not in _WINDOWS:
+        win = getattr(np, name)(size) if name else np.ones(size)
+        win.flags.writeable = False
+        _WINDOWS[key] = win
+    return _WINDOWS[key]
+
+
+def frequencies(nperseg, spacing, onesided=True):
+    """
+    returns the frequency (Hz) of each bin returned by welch for segments of
+    nperseg samples taken every spacing seconds
+    """
+    bins = nperseg // 2 if onesided else nperseg
+    return np.arange(bins) / (nperseg * spacing)
+
+
+def welch(data, nperseg=None, noverlap=None, window_name='hanning', onesided=True,
+          scaling='density', fs=1.0):
+    """
+    returns the Welch averaged power spectral density of data, the mean of |fft|**2
+    over overlapping windowed segments divided by fs * sum(window**2) (as
+    scipy.signal.welch), so levels and the integrated noise
+    sqrt(sum(power) * fs / nperseg) don't depend on nperseg. With scaling=None the
+    mean |fft|**2 is returned as is: for nperseg=None (a single segment covering
+    all of data) np.sqrt of it is abs(np.fft.fft(data * window)), as plotted by
+    lwplot.plot_fft
+
+    Parameters
+    ----------
+    data : np.ndarray or sequence of np.ndarray
+        (N,) samples, (N, boards) samples or a list of equal length board arrays.
+        boards are transformed together, one batch of at most BATCH_BYTES of
+        segments at a time, or one board at a time when a segment of every board
+        is bigger than that, so a list of boards is never stacked into one big array
+
+    nperseg : int, optional
+        segment length, all of data if None
+
+    noverlap : int, optional
+        samples shared by consecutive segments, nperseg // 2 if None
+
+    window_name : str, optional
+        name of the numpy window function, None for no window
+
+    onesided : bool, optional
+        if True only the first nperseg // 2 bins (positive frequencies) are returned.
+        Real data is transformed with rfft in that case. The bins aren't doubled,
+        the density is two sided either way
+
+    scaling : str, optional
+        'density' for a power spectral density, None for the mean |fft|**2
+
+    fs : float, optional
+        sampling frequency (Hz) of data, for 'density'
+
+    Returns
+    -------
+    np.ndarray
+        (bins,) or (bins, boards) float64 power
+    """
+    boards, single = _boards(data)
+    nperseg, step, segments = _layout(boards[0].size, nperseg, noverlap)
+    real = not any(np.iscomplexobj(board) for board in boards)
+    bins = _bins(nperseg, real, onesided)
+    win = window(nperseg, window_name)
+    power = _segment_power(boards, segments, nperseg, step, win, real, bins)
+    power /= segments * _normalization(win, scaling, fs)
+
+    return power[:, 0] if single else power
+
+
+def cross_spectra(data, nperseg=None, noverlap=None, window_name='hanning',
+                  onesided=True, detrend=True):
+    """
+    returns the Welch averaged cross spectral matrix of the boards of data, a
+    (bins, boards, boards) complex np.ndarray with csd[:, i, j] the mean over
+    segments of fft_i * conj(fft_j). Every board is transformed once per segment
+    and all the pairs come from the same transforms. Without detrend the
+    diagonal is welch(data, scaling=None)
+
+    Parameters
+    ----------
+    data, nperseg, noverlap, window_name, onesided :
+        as for welch. coherence needs several segments, so give nperseg. lag
+        correlation needs the full spectrum, onesided=False
+
+    detrend : bool, optional
+        subtract the mean of each segment before windowing, so the carrier
+        doesn't dominate the low frequencies and the correlation
+    """
+    boards, _ = _boards(data)
+    nperseg, step, segments = _layout(boards[0].size, nperseg, noverlap)
+    real = not any(np.iscomplexobj(board) for board in boards)
+    bins = _bins(nperseg, real, onesided)
+    csd = np.zeros((bins, len(boards), len(boards)), dtype=np.complex128)
+    for spec in _segment_spectra(boards, segments, nperseg, step,
+                                 window(nperseg, window_name), real, bins, detrend):
+        csd += np.einsum('sfi,sfj->fij', spec, spec.conj())
+    return csd / segments
+
+
+def coherence(csd):
+    """
+    returns the (bins, boards, boards) magnitude squared coherence
+    |csd_ij|**2 / (csd_ii csd_jj) of a cross_spectra matrix, in [0, 1]
+    """
+    power = np.einsum('fii->fi', csd).real
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return abs(csd) ** 2 / (power[:, :, np.newaxis] * power[:, np.newaxis, :])
+
+
+def correlation(csd, nperseg):
+    """
+    returns (lags, corr): the normalised cross correlation of every pair of boards
+    from a full spectrum (onesided=False) cross_spectra matrix of segments of
+    nperseg samples. corr[k, i, j] is the correlation coefficient of board i
+    shifted back by lags[k] samples against board j, so it peaks at lags[k] = d
+    when board i lags board j by d samples. lags run from -nperseg // 2 to
+    nperseg // 2 - 1 (averaged over windowed segments, so it tapers with the lag)
+    """
+    if csd.shape[0] == nperseg:
+        corr = np.fft.ifft(csd, axis=0)
+    else:
+        assert csd.shape[0] == nperseg // 2 + 1, \
+            "correlation needs a full spectrum, use cross_spectra(..., onesided=False)"
+        corr = np.fft.irfft(csd, nperseg, axis=0)
+    zero = np.sqrt(abs(np.einsum('ii->i', corr[0])))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = corr / (zero[:, np.newaxis] * zero[np.newaxis, :])
+    return np.fft.fftshift(np.fft.fftfreq(nperseg, 1.0 / nperseg)), \
+        np.fft.fftshift(corr, axes=0)
+
+
+class WelchAccumulator(object):
+    """
+    Welch averaged power spectrum of a stream of (n, boards) blocks, for captures
+    which are still growing or too big to hold. Samples which don't yet fill a
+    whole segment are carried to the next update. power() is welch over everything
+    given to update so far
+
+    Parameters
+    ----------
+    nperseg : int
+        segment length
+
+    noverlap : int, optional
+        samples shared by consecutive segments, nperseg // 2 if None
+
+    window_name : str, optional
+        name of the numpy window function, None for no window
+
+    onesided, scaling, fs : optional
+        see welch
+    """
+    def __init__(self, nperseg, noverlap=None, window_name='hanning', onesided=True,
+                 scaling='density', fs=1.0):
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None else noverlap
+        assert 0 <= self.noverlap < nperseg, "noverlap must be less than nperseg"
+        self.window_name = window_name
+        self.onesided = onesided
+        self.scale = _normalization(window(nperseg, window_name), scaling, fs)
+        self.carry = None
+        self.total = None
+        self.segments = 0
+
+    def update(self, block):
+        """ adds the rows of block ((n,) or (n, boards)) to the estimate """
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        data = block if self.carry is None else np.concatenate((self.carry, block))
+
+        step = self.nperseg - self.noverlap
+        segments = 0 if data.shape[0] < self.nperseg else \
+            1 + (data.shape[0] - self.nperseg) // step
+        if segments:
+            real = not np.iscomplexobj(data)
+            bins = _bins(self.nperseg, real, self.onesided)
+            power = _segment_power([data[:, i] for i in range(data.shape[1])], segments,
+                                   self.nperseg, step,
+                                   window(self.nperseg, self.window_name), real, bins)
+            self.total = power if self.total is None else self.total + power
+            self.segments += segments
+        self.carry = data[segments * step:].copy()
+
+    def power(self):
+        """ returns the (bins, boards) power averaged so far, None before a segment """
+        if not self.segments:
+            return None
+        return self.total / (self.segments * self.scale)
+
+
+def spectrogram(data, nperseg, noverlap=None, decimate=1, window_name='hanning',
+                onesided=True, block_rows=1 << 18, scaling='density', fs=1.0):
+    """
+    returns (starts, power): the short time power spectra of data, one per group of
+    decimate consecutive segments, as a (times, bins, boards) np.ndarray, and the
+    first row of each group. see iter_spectrogram, which this collects
+    """
+    starts = []
+    rows = []
+    for start, power in iter_spectrogram(data, nperseg, noverlap, decimate, window_name,
+                                         onesided, block_rows, scaling, fs):
+        starts.append(start)
+        rows.append(power)
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0, 0))
+    return np.array(starts), np.array(rows)
+
+
+def iter_spectrogram(data, nperseg, noverlap=None, decimate=1, window_name='hanning',
+                     onesided=True, block_rows=1 << 18, scaling='density', fs=1.0):
+    """
+    yields (first row, (bins, boards) power) for every group of decimate consecutive
+    segments of data, each the Welch average of its group. Only block_rows rows
+    (plus a partial group) are held at a time, so memory is proportional to the
+    output rather than the capture
+
+    Parameters
+    ----------
+    data : np.ndarray, sequence of np.ndarray or iterable of blocks
+        (N,) or (N, boards) samples, a list of equal length board arrays (as for
+        welch) or any iterable of (n, boards) blocks or of dicts holding them as
+        'raw', eg. from lwparse.iter_parse or lwparse.LdumpData.iter_blocks
+
+    nperseg, noverlap, window_name, onesided, scaling, fs :
+        as for welch
+
+    decimate : int, optional
+        segments averaged into each output time
+    """
+    noverlap = nperseg // 2 if noverlap is None else noverlap
+    assert 0 <= noverlap < nperseg, "noverlap must be less than nperseg"
+    step = nperseg - noverlap
+    group = decimate * step
+    win = window(nperseg, window_name)
+    scale = decimate * _normalization(win, scaling, fs)
+
+    carry = None
+    first = 0
+    for block in _iter_blocks(data, block_rows):
+        buf = block if carry is None else np.concatenate((carry, block))
+        real = not np.iscomplexobj(buf)
+        bins = _bins(nperseg, real, onesided)
+        # a group is complete once its last segment fits
+        groups = 0 if buf.shape[0] < (decimate - 1) * step + nperseg else \
+            1 + (buf.shape[0] - (decimate - 1) * step - nperseg) // group
+        for i in range(groups):
+            boards = [buf[i * group:, j] for j in range(buf.shape[1])]
+            power = _segment_power(boards, decimate, nperseg, step, win, real, bins)
+            yield first + i * group, power / scale
+        carry = buf[groups * group:]
+        first += groups * group
+
+
+def _iter_blocks(data, block_rows):
+    """ yields (n, boards) blocks of data (see iter_spectrogram) """
+    if isinstance(data, np.ndarray) or (isinstance(data, (list, tuple)) and
+                                        isinstance(data[0], np.ndarray) and
+                                        data[0].ndim == 1):
+        boards, _ = _boards(data)
+        for start in range(0, boards[0].size, block_rows):
+            yield np.column_stack([board[start:start + block_rows] for board in boards])
+    else:
+        for block in data:
+            if isinstance(block, dict):
+                block = block['raw']
+            block = np.asarray(block)
+            yield block[:, np.newaxis] if block.ndim == 1 else block
+
+
+def _layout(size, nperseg, noverlap):
+    """ returns (nperseg, step, segments) of Welch segments of size samples """
+    nperseg = size if nperseg is None else min(nperseg, size)
+    noverlap = nperseg // 2 if noverlap is None else noverlap
+    assert 0 <= noverlap < nperseg, "noverlap must be less than nperseg"
+    step = nperseg - noverlap
+    return nperseg, step, 1 + (size - nperseg) // step
+
+
+def _normalization(win, scaling, fs):
+    """ returns what the mean |fft|**2 is divided by for welch's scaling """
+    if scaling is None:
+        return 1.0
+    assert scaling == 'density', "scaling must be 'density' or None"
+    return fs * np.dot(win, win)
+
+
+def _bins(nperseg, real, onesided):
+    """ returns the number of bins welch returns """
+    if onesided:
+        return nperseg // 2
+    return nperseg // 2 + 1 if real else nperseg
+
+
+def _segment_power(boards, segments, nperseg, step, win, real, bins):
+    """
+    returns the (bins, boards) sum of |fft|**2 of the first segments windowed
+    segments of every board, transformed a batch of segments at a time
+    float32 (complex64) boards are windowed and transformed in single precision
+    (where numpy's fft supports it), the sum is float64
+    """
+    if len(boards) > 1 and nperseg * len(boards) * _itemsize(boards) > BATCH_BYTES:
+        # a batch would hold a single segment, transform the boards one at a time
+        return np.column_stack([_segment_power([board], segments, nperseg, step, win,
+                                               real, bins)[:, 0] for board in boards])
+    power = np.zeros((bins, len(boards)))
+    for spec in _segment_spectra(boards, segments, nperseg, step, win, real, bins):
+        magnitude = np.square(spec.real)
+        magnitude += np.square(spec.imag)
+        power += magnitude.sum(axis=0, dtype=np.float64)
+    return power
+
+
+def _segment_spectra(boards, segments, nperseg, step, win, real, bins, detrend=False):
+    """
+    yields the (count, bins, boards) ffts of the first segments windowed segments
+    of every board, a batch of segments at a time. With detrend each segment's
+    mean is subtracted before windowing
+    """
+    precision = np.result_type(np.float32, *[board.dtype for board in boards])
+    win = win.astype(np.finfo(precision).dtype, copy=False)[:, np.newaxis]
+    batch = max(1, BATCH_BYTES // (nperseg * len(boards) * _itemsize(boards)))
+    for first in range(0, segments, batch):
+        count = min(batch, segments - first)
+        # (count, nperseg, boards) batch of segments, copied from strided views, so
+        # it can be detrended and windowed in place
+        segs = np.stack([_segments(board, first * step, count, nperseg, step)
+                         for board in boards], axis=-1).astype(precision, copy=False)
+        if detrend:
+            segs -= segs.mean(axis=1, keepdims=True)
+        segs *= win
+        if real:
+            spec = np.fft.rfft(segs, axis=1)
+        else:
+            spec = np.fft.fft(segs, axis=1)
+        del segs
+        yield spec[:, :bins]
+
+
+def _itemsize(boards):
+    """ returns the bytes per sample of the ffts of boards """
+    precision = np.result_type(np.float32, *[board.dtype for board in boards])
+    return np.dtype(np.result_type(precision, np.complex64)).itemsize
+
+
+def _boards(data):
+    """ returns (list of 1-D board arrays, True if data was a single 1-D array) """
+    if isinstance(data, np.ndarray):
+        if data.ndim == 1:
+            return [data], True
+        return [data[:, i] for i in range(data.shape[1])], False
+    boards = [np.asarray(board) for board in data]
+    assert len(set(board.size for board in boards)) == 1, "boards must have same length"
+    return boards, False
+
+
+def _segments(arr, start, count, nperseg, step):
+    """ returns a (count, nperseg) read only view of segments of arr from start """
+    arr = arr[start:]
+    stride = arr.strides[0]
+    return as_strided(arr, shape=(count, nperseg), strides=(step * stride, stride),
+                      writeable=False)
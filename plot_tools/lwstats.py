@@ -0,0 +1,144 @@
+"""
+computes per board statistics of ldump captures without plotting anything
+(matplotlib is never imported) and writes them as JSON or CSV
+"""
+from __future__ import print_function
+import argparse
+import csv
+import json
+import sys
+import numpy as np
+
+import lwparse
+import lwspectrum
+from ldumpfile import LdumpFile
+
+BOARDS = ['llrf1','llrf1molk1','llrf1molk2','llrf2molk1']
+NPERSEG = 1 << 14
+FIELDS = ['amp_mean', 'amp_std', 'phase_std', 'integrated_noise', 'i_std', 'q_std']
+
+
+class RunningMoments(object):
+    """
+    running mean and covariance of the columns of a stream of (n, columns) blocks
+    sums are taken relative to the mean of the first block to avoid cancellation
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.shift = None
+        self.sums = None
+        self.products = None
+
+    def update(self, block):
+        """ adds the rows of block """
+        if not block.shape[0]:
+            return
+        if self.shift is None:
+            self.shift = block.mean(axis=0)
+            self.sums = np.zeros(block.shape[1])
+            self.products = np.zeros((block.shape[1], block.shape[1]))
+        centred = block - self.shift
+        self.count += block.shape[0]
+        self.sums += centred.sum(axis=0)
+        self.products += np.dot(centred.T, centred)
+
+    def mean(self):
+        """ returns the mean of each column """
+        return self.shift + self.sums / self.count
+
+    def cov(self):
+        """ returns the (population) covariance matrix of the columns """
+        centred_mean = self.sums / self.count
+        return self.products / self.count - np.outer(centred_mean, centred_mean)
+
+
+def analyze(filename, nperseg=NPERSEG, block_rows=lwparse.BLOCK_ROWS):
+    """
+    returns a list with a dict of FIELDS for each board of filename, computed in a
+    single streaming pass of block_rows rows at a time:
+    amplitude mean and std, std of the unwrapped phase, integrated noise (the last
+    point of lwplot.plot_spectrum's integral, independent of nperseg) and the std
+    of I and Q after rotating the mean onto the I axis (as lwplot.plot_bottom does)
+    """
+    ldump = LdumpFile(filename)
+    amplitude = RunningMoments()
+    phase = RunningMoments()
+    iq = [RunningMoments() for _ in BOARDS]
+    tracker = lwparse.PhaseTracker()
+    spectrum = lwspectrum.WelchAccumulator(nperseg, fs=1.0 / ldump.twave)
+
+    for data in lwparse.iter_columns(filename, block_rows):
+        raw = (data[:, 0::2] + 1j * data[:, 1::2]) / ldump.yscale
+        amplitude.update(abs(raw))
+        phase.update(tracker.update(raw))
+        for i, moments in enumerate(iq):
+            moments.update(np.column_stack((raw[:, i].real, raw[:, i].imag)))
+        spectrum.update(raw)
+
+    power = spectrum.power()
+    if power is None:
+        # shorter than a segment, use the single segment it does have
+        raw = np.column_stack(ldump.data()['raw'])
+        power = lwspectrum.welch(raw, fs=1.0 / ldump.twave)
+        nperseg = raw.shape[0]
+    # bin width (Hz) of the density
+    width = 1.0 / (nperseg * ldump.twave)
+
+    stats = []
+    amp_std = np.sqrt(np.diag(amplitude.cov()))
+    phase_std = np.sqrt(np.diag(phase.cov()))
+    for i, moments in enumerate(iq):
+        i_mean, q_mean = moments.mean()
+        theta = np.arctan2(q_mean, i_mean)
+        rotate = np.array([[np.cos(theta), np.sin(theta)],
+                           [-np.sin(theta), np.cos(theta)]])
+        i_var, q_var = np.diag(np.dot(np.dot(rotate, moments.cov()), rotate.T))
+        stats.append({
+            'board': BOARDS[i],
+            'amp_mean': float(amplitude.mean()[i]),
+            'amp_std': float(amp_std[i]),
+            'phase_std': float(phase_std[i]),
+            'integrated_noise': float(np.sqrt(power[:, i].sum() * width)),
+            'i_std': float(np.sqrt(i_var)),
+            'q_std': float(np.sqrt(q_var)),
+        })
+    return stats
+
+
+def write_json(results, out):
+    """ writes {filename: [board stats]} as JSON to out """
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+def write_csv(results, out):
+    """ writes one CSV row per file and board to out """
+    writer = csv.writer(out)
+    writer.writerow(['file', 'board'] + FIELDS)
+    for filename in sorted(results):
+        for board in results[filename]:
+            writer.writerow([filename, board['board']] + [board[field] for field in FIELDS])
+
+
+def main(argv):
+    """ analyzes the ldump files given in argv """
+    parser = argparse.ArgumentParser(description="Per board statistics of ldump captures")
+    parser.add_argument("files", nargs='+', help="ldump files to analyze")
+    parser.add_argument("--format", choices=['json', 'csv'], default='json')
+    parser.add_argument("-o", "--output", help="file to write, stdout if not given")
+    parser.add_argument("-n", "--nperseg", type=int, default=NPERSEG,
+                        help="spectrum segment length")
+    args = parser.parse_args(argv[1:])
+
+    results = dict((filename, analyze(filename, args.nperseg)) for filename in args.files)
+    write = write_json if args.format == 'json' else write_csv
+    if args.output:
+        with open(args.output, 'w') as out:
+            write(results, out)
+    else:
+        write(results, sys.stdout)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,29 @@
+""" checks that the streamed spectrogram matches the in memory one """
+import numpy as np
+
+import lwbench
+import lwparse
+import lwspectrum
+
+ROWS = 20000
+NPERSEG = 1024
+BLOCK_ROWS = 3000
+
+
+def test_spectrogram_of_iter_parse(tmpdir):
+    """ iter_parse blocks (dicts) go straight into spectrogram """
+    filename = str(tmpdir.join('capture.ldump'))
+    lwbench.write_ldump(filename, ROWS)
+    data = lwparse.parse(filename, lwbench.YSCALE, 512, cache=False)
+    expected_starts, expected = lwspectrum.spectrogram(list(data['raw']), NPERSEG,
+                                                       decimate=3)
+
+    blocks = lwparse.iter_parse(filename, lwbench.YSCALE, 512, block_rows=BLOCK_ROWS)
+    starts, power = lwspectrum.spectrogram(blocks, NPERSEG, decimate=3)
+    assert np.array_equal(starts, expected_starts)
+    assert np.allclose(power, expected, rtol=1e-10, atol=0)
+
+    starts, power = lwspectrum.spectrogram(data.iter_blocks(BLOCK_ROWS), NPERSEG,
+                                           decimate=3)
+    assert np.array_equal(starts, expected_starts)
+    assert np.allclose(power, expected, rtol=1e-10, atol=0)
@@ -0,0 +1,17 @@
+""" checks that the copies of stagetimer match the master in plot_tools """
+import io
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MASTER = os.path.join(ROOT, 'plot_tools', 'stagetimer.py')
+COPIES = [os.path.join(ROOT, 'signalgen', 'stagetimer.py'),
+          os.path.join(ROOT, 'signalgen', 'examples', 'stagetimer.py')]
+
+
+def test_copies_match_master():
+    """ signalgen's copies of stagetimer are byte identical to the master """
+    with io.open(MASTER, 'rb') as filep:
+        master = filep.read()
+    for copy in COPIES:
+        with io.open(copy, 'rb') as filep:
+            assert filep.read() == master, copy + " differs from " + MASTER
@@ -1,8 +1,15 @@
 """ contains methods to interface with signal generators """
+import select
 import socket
 
+import stagetimer
+
 DEFAULT_ADDRESS = ('131.243.201.231', 18)
 MHZ = 1000000
+TIMEOUT = 10
+RECV_SIZE = 4096
+# the instrument holds at most this many list sweep points
+LIST_POINTS = 4000
 
 
 class ValueSetException(Exception):
@@ -13,16 +20,222 @@ class ValueSetException(Exception):
     pass
 
 
+class SCPITransport(object):
+    """
+    newline framed SCPI messages over a TCP socket
+
+    writes are queued and sent together by flush, so several commands cost a single
+    TCP write, and replies are read through a persistent byte buffer which may hold
+    several lines from one recv. Queries can be pipelined: queue them, flush once and
+    read the replies back in order (see batch)
+
+    Parameters
+    ----------
+    address : tuple ('ip.address', port)
+        address tuple to be passed to socket
+
+    timeout : float, optional
+        seconds before a blocked send or recv raises socket.timeout
+
+    nodelay : bool, optional
+        disables Nagle's algorithm (TCP_NODELAY) so short messages aren't held back
+        waiting for the acknowledgement of the previous one
+
+    Returns
+    -------
+    SCPITransport object
+    """
+    def __init__(self, address, timeout=TIMEOUT, nodelay=True):
+        self.addr = address
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.set_nodelay(nodelay)
+        self.rbuf = bytearray()
+        self.wbuf = []
+        self.deferred = 0
+        self.deferred_replies = []
+
+    def set_nodelay(self, nodelay=True):
+        """ turns TCP_NODELAY on or off """
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(nodelay)))
+
+    def alive(self):
+        """
+        returns False if the connection is known to be dead: closed or reset by the
+        instrument, or closed here. Doesn't block, replies already received are moved
+        to the read buffer so a close behind them is seen too
+        """
+        try:
+            while select.select([self.sock], [], [], 0)[0]:
+                chunk = self.sock.recv(RECV_SIZE)
+                if not chunk:
+                    return False
+                self.rbuf.extend(chunk)
+        except (socket.error, ValueError):
+            return False
+        return True
+
+    def write(self, msg):
+        """ queues string msg, \n terminated if it isn't already, until flush """
+        if not msg.endswith('\n'):
+            msg += '\n'
+        self.wbuf.append(msg.encode())
+
+    def flush(self):
+        """ sends every queued message in a single write """
+        if self.wbuf:
+            data = b''.join(self.wbuf)
+            self.wbuf = []
+            self.sock.sendall(data)
+
+    def defer(self, msg):
+        """
+        sends query msg now but leaves its reply to be collected later, so queries
+        can be checked without waiting on the round trip of each one
+        """
+        self.send(msg)
+        self.deferred += 1
+
+    def collect(self):
+        """ returns the replies of every deferred query so far, in order """
+        self._drain()
+        replies = self.deferred_replies
+        self.deferred_replies = []
+        return replies
+
+    def _drain(self):
+        """ reads the outstanding deferred replies, which precede any other reply """
+        self.flush()
+        while self.deferred:
+            self.deferred_replies.append(self._readline())
+            self.deferred -= 1
+
+    def readline(self):
+        """ returns the next \n terminated reply (with its \n) as a string """
+        self._drain()
+        return self._readline()
+
+    def _readline(self):
+        """ returns the next line of the read buffer, receiving until there is one """
+        end = self.rbuf.find(b'\n')
+        while end < 0:
+            chunk = self.sock.recv(RECV_SIZE)
+            if not chunk:
+                raise socket.error("connection to {} closed".format(self.addr))
+            self.rbuf.extend(chunk)
+            end = self.rbuf.find(b'\n')
+        line = bytes(self.rbuf[:end + 1])
+        del self.rbuf[:end + 1]
+        return line.decode('utf-8')
+
+    def recv(self, buff_size):
+        """ returns up to buff_size bytes, buffered ones first, as a string """
+        if not self.rbuf:
+            self.flush()
+            return self.sock.recv(buff_size).decode('utf-8')
+        data = bytes(self.rbuf[:buff_size])
+        del self.rbuf[:buff_size]
+        return data.decode('utf-8')
+
+    def send(self, msg):
+        """ sends msg (and anything queued before it) now """
+        self.write(msg)
+        self.flush()
+
+    def query(self, msg):
+        """ sends msg and returns its reply """
+        self.send(msg)
+        return self.readline()
+
+    def exchange(self, messages, expected):
+        """ sends messages in a single write and returns the next expected replies """
+        for msg in messages:
+            self.write(msg)
+        self.flush()
+        return [self.readline() for _ in range(expected)]
+
+    def batch(self):
+        """ returns a Batch pipelining messages over this transport """
+        return Batch(self)
+
+    def close(self):
+        """ closes the socket """
+        self.sock.close()
+
+
+class Batch(object):
+    """
+    pipelined messages: commands and queries are queued, then execute (or leaving a
+    with block) sends them all in one write and reads the replies of the queries in
+    order, so n queries cost one round trip instead of n
+
+        with gen.batch() as batch:
+            batch.send(':POW -10')
+            batch.query(':POW?')
+        batch.replies   # ['-10.0\n']
+
+    the queue is kept here and handed to target.exchange, a SCPITransport or a
+    BNC845 (which reconnects and sends it again if the connection drops)
+    """
+    def __init__(self, target):
+        self.target = target
+        self.messages = []
+        self.expected = 0
+        self.replies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            # nothing was sent, drop the queue
+            self.messages = []
+            self.expected = 0
+        return False
+
+    def send(self, msg):
+        """ queues command msg """
+        self.messages.append(msg)
+
+    def query(self, msg):
+        """ queues query msg, returns the index its reply will have in replies """
+        self.messages.append(msg)
+        self.expected += 1
+        return self.expected - 1
+
+    def execute(self):
+        """ sends the queue and returns the replies of the queries in order """
+        with stagetimer.stage('query'):
+            self.replies = self.target.exchange(self.messages, self.expected)
+        self.messages = []
+        self.expected = 0
+        return self.replies
+
+
 class BNC845(object):
     """
     class which represents a BNC845 signal generator through a low-level socket connection
     (https://www.berkeleynucleonics.com/microwave-signal-generators)
     all methods will timeout after 10 seconds if communication can't be established
+    messages go through a SCPITransport, batch() pipelines several in one round trip
+    a dead connection is reopened by every message (queries, sends, deferred sets
+    and batches), see reconnect. A timeout closes the connection instead, a late
+    reply would otherwise answer the next query, and the next message reopens it
     """
 
-    def __init__(self, address=DEFAULT_ADDRESS):
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=TIMEOUT, nodelay=True):
         self.addr = address
-        self.sock = socket.create_connection(address, timeout=10)
+        self.timeout = timeout
+        self.nodelay = nodelay
+        self.transport = SCPITransport(address, timeout, nodelay)
+        self.sock = self.transport.sock
+        # (name, value, tolerance, scale) of each deferred check, see verify_deferred
+        self.deferred_checks = []
+        # deferred checks whose replies were lost with a connection
+        self.lost_checks = 0
+        # last frequency, power and rf state set, restored by reconnect
+        self.state = {}
 
     def identify(self):
         """ returns identification string of inst """
@@ -35,35 +248,112 @@ class BNC845(object):
         returns reply
         if msg is not \n terminated, \n is added
         """
-        if msg[len(msg) - 1] != '\n':
-            msg += '\n'
-        self.send(msg)
-        ret = self.recv(4096)
-        while ret[len(ret) - 1] != '\n':
-            ret += self.recv(4096)
-        return ret
+        with stagetimer.stage('query'):
+            return self._io('query', (msg,))
 
     def send(self, msg):
         """ sends string msg as utf-8 encoded bytes to instrument """
-        self.sock.send(msg.encode())
+        self._io('send', (msg,))
+
+    def exchange(self, messages, expected):
+        """ sends messages and returns expected replies, see SCPITransport.exchange """
+        return self._io('exchange', (messages, expected))
+
+    def _io(self, method, args=(), retry=True):
+        """
+        calls transport.method(*args), reconnecting first if the connection is dead
+        and calling it once more on a new connection if the connection fails (reset,
+        broken pipe, closed by the instrument). A timeout isn't retried, nor is any
+        failure if retry is False: the message may have been executed, so the
+        connection is closed (the next message reopens it) and the error raised
+        """
+        # the messages about to be sent, a reconnect mustn't undo an rf change in them
+        pending = args[0] if method == 'exchange' else args[:1]
+        if not self.transport.alive():
+            self.reconnect(pending)
+        try:
+            return getattr(self.transport, method)(*args)
+        except socket.timeout:
+            self.transport.close()
+            raise
+        except socket.error:
+            if not retry:
+                self.transport.close()
+                raise
+            self.reconnect(pending)
+            return getattr(self.transport, method)(*args)
+
+    def reconnect(self, pending=()):
+        """
+        replaces the connection with a new one and restores the frequency, power
+        and rf state last set through this object, verified in one round trip.
+        The rf state isn't restored if one of the pending messages (about to be
+        sent on the new connection) sets it, so a failed rf_off can't turn rf on.
+        The replies of deferred checks were lost with the old connection, they are
+        counted in lost_checks and reported by verify_deferred.
+        List sweeps aren't restored
+        Raise ValueSetException if the state could not be restored
+        """
+        try:
+            self.transport.close()
+        except socket.error:
+            pass
+        self.transport = SCPITransport(self.addr, self.timeout, self.nodelay)
+        self.sock = self.transport.sock
+        self.lost_checks += len(self.deferred_checks)
+        self.deferred_checks = []
+
+        checks = []
+        with self.transport.batch() as batch:
+            if 'freq' in self.state:
+                batch.send(':FREQ ' + str(self.state['freq']) + 'MHZ')
+                batch.query(':FREQ?')
+                checks.append(('Frequency', self.state['freq'], 1E-5, MHZ))
+            if 'power' in self.state:
+                batch.send(':POW ' + str(self.state['power']))
+                batch.query(':POW?')
+                checks.append(('Power', self.state['power'], 1E-5, 1))
+            if 'rf' in self.state and not any(':OUTP ' in msg.upper() for msg in pending):
+                batch.send(':OUTP ON' if self.state['rf'] else ':OUTP OFF')
+        for (name, value, tolerance, scale), reply in zip(checks, batch.replies):
+            self._check(name, reply, value, tolerance, scale)
+
+    def close(self):
+        """ closes the connection """
+        self.transport.close()
 
     def recv(self, buff_size):
         """ returns buff_size number of bytes from instrument """
-        return self.sock.recv(buff_size).decode('utf-8')
+        return self.transport.recv(buff_size)
+
+    def batch(self):
+        """ returns a Batch of pipelined messages, see SCPITransport """
+        return Batch(self)
+
+    def set_nodelay(self, nodelay=True):
+        """ turns TCP_NODELAY on or off """
+        self.nodelay = nodelay
+        self.transport.set_nodelay(nodelay)
 
-    def set_freq(self, new_freq, check=True):
+    def set_freq(self, new_freq, check=True, defer=False):
         """
         sets frequency to freq (MHZ)
-        if check is True then asks instrument if frequency was properly set
+        if check is True then asks instrument if frequency was properly set, in the
+        same message as the set so it costs one round trip
+        if defer is True the check is left for verify_deferred
         Error to pass no frequency
         Raise ValueSetException if frequency could not be set
         """
         assert new_freq is not None
-        self.send(':FREQ ' + str(new_freq) + 'MHZ\n')
-
-        if check and abs(self.get_freq() / MHZ - new_freq) > 1E-5:
-            raise ValueSetException(
-                "Frequency could not be set {0:>.2}".format(new_freq))
+        msg = ':FREQ ' + str(new_freq) + 'MHZ'
+        if not check:
+            self.send(msg + '\n')
+        elif defer:
+            self._io('defer', (msg + ';:FREQ?',))
+            self.deferred_checks.append(('Frequency', new_freq, 1E-5, MHZ))
+        else:
+            self._check('Frequency', self.query(msg + ';:FREQ?'), new_freq, 1E-5, MHZ)
+        self.state['freq'] = new_freq
 
     def get_freq(self):
         """ returns the frequency on the front panel of the instrument in MHZ """
@@ -80,19 +370,60 @@ class BNC845(object):
         self.set_freq(new_freq, check=True)
         return new_freq
 
-    def set_power(self, new_power, check=True):
+    def set_power(self, new_power, check=True, defer=False):
         """
         set power to power in dbm
-        if check is True then asks instrument if power was properly set
+        if check is True then asks instrument if power was properly set, in the
+        same message as the set so it costs one round trip
+        if defer is True the check is left for verify_deferred
         Error to pass no power
         Raise ValueSetException if power could not be set
         """
         assert new_power is not None
-        self.send(':POW ' + str(new_power) + '\n')
+        msg = ':POW ' + str(new_power)
+        if not check:
+            self.send(msg + '\n')
+        elif defer:
+            self._io('defer', (msg + ';:POW?',))
+            self.deferred_checks.append(('Power', new_power, 1E-5, 1))
+        else:
+            self._check('Power', self.query(msg + ';:POW?'), new_power, 1E-5, 1)
+        self.state['power'] = new_power
+
+    def verify_deferred(self):
+        """
+        reads the replies of every deferred set (set_freq, set_power with defer=True)
+        in one go and checks them in order
+        Raise ValueSetException for the first value which wasn't set, or if the
+        replies of some checks were lost with a dropped connection
+        """
+        replies = self._io('collect')
+        checks = self.deferred_checks
+        self.deferred_checks = []
+        lost = self.lost_checks
+        self.lost_checks = 0
+        for (name, value, tolerance, scale), reply in zip(checks, replies):
+            self._check(name, reply, value, tolerance, scale)
+        if lost:
+            raise ValueSetException("{0} deferred checks were lost with the connection to "
+                                    "{1}, their values weren't verified".format(lost, self.addr))
 
-        if check and abs(self.get_power() - new_power) > 1E-5:
+    def discard_deferred(self):
+        """ reads and forgets the replies of deferred sets, eg. after an error """
+        self.deferred_checks = []
+        self.lost_checks = 0
+        try:
+            self.transport.collect()
+        except socket.error:
+            # the replies went with the connection, the next message reopens it
+            self.transport.close()
+
+    @staticmethod
+    def _check(name, reply, value, tolerance, scale):
+        """ raises ValueSetException if reply / scale isn't value within tolerance """
+        if abs(float(reply) / scale - value) > tolerance:
             raise ValueSetException(
-                "Power could not be set {0:>.2}".format(new_power))
+                "{0} could not be set {1:>.2}".format(name, float(value)))
 
     def get_power(self):
         """ returns the power on the front panel of the instrument in dbm """
@@ -109,10 +440,49 @@ class BNC845(object):
 
         return new_power
 
+    def upload_power_list(self, powers):
+        """
+        loads powers (dbm) as the instrument's power list and sets it to step
+        through the list one point per bus trigger (see trigger). The list is sent
+        and read back in a single round trip
+        Raise ValueSetException if the list read back doesn't match
+        """
+        assert 0 < len(powers) <= LIST_POINTS, "list sweeps hold 1 to {} points".format(
+            LIST_POINTS)
+        powers = [float(power) for power in powers]
+        with self.batch() as batch:
+            batch.send(':LIST:TYPE LIST')
+            batch.send(':LIST:POW ' + ','.join(str(power) for power in powers))
+            batch.send(':TRIG:SOUR BUS')
+            batch.send(':TRIG:TYPE POINT')
+            batch.send(':POW:MODE LIST')
+            batch.query(':LIST:POW?')
+        uploaded = [float(power) for power in batch.replies[0].split(',')]
+        if len(uploaded) != len(powers) or any(
+                abs(got - power) > 1E-5 for got, power in zip(uploaded, powers)):
+            raise ValueSetException("Power list could not be set")
+
+    def start_list(self):
+        """ arms the list sweep, each trigger then moves to the next point """
+        self.send(':INIT')
+
+    def trigger(self):
+        """
+        sends a bus trigger, the list sweep moves to its next point
+        a trigger isn't sent again after a connection error, it may have been received
+        """
+        self._io('send', ('*TRG',), retry=False)
+
+    def stop_list(self):
+        """ leaves list mode, the power is fixed again """
+        self.send(':POW:MODE FIX')
+
     def rf_on(self):
         """ Tells instrument to turn on rf signal """
         self.send(':OUTP ON\n')
+        self.state['rf'] = True
 
     def rf_off(self):
         """ Tells instrument to turn off rf signal """
         self.send(':OUTP OFF\n')
+        self.state['rf'] = False
@@ -0,0 +1,296 @@
+"""
+asyncio drivers for the BNC845 and the visa spectrum analyzers (python 3.5+ only)
+
+AsyncBNC845 talks to the generator over asyncio streams. AsyncAnalyzer runs the
+blocking pyvisa calls of an analyzer (specanalyzer.RandSFSP, HP8593E,
+visainst.SpecAnalyzer) in a thread of its own, so waiting on one instrument no
+longer blocks the others and a single event loop can drive several of them
+
+    async def main():
+        gen = await AsyncBNC845.connect(('131.243.201.231', 18))
+        spec = AsyncAnalyzer(RandSFSP('GPIB::18'))
+        await gen.set_freq(185.7)
+        await spec.set_window(185.7, 10, -30)
+        return await power_sweep(gen, powers, spec.peak_power, write, spec.take_sweep)
+
+    results = asyncio.get_event_loop().run_until_complete(main())
+
+several sweeps (one generator and analyzer each) run at once with asyncio.gather
+"""
+import asyncio
+import functools
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import stagetimer
+from bncinst import BNC845, DEFAULT_ADDRESS, MHZ, TIMEOUT
+
+# seconds the output settles after rf is turned on
+SETTLE = 1.0
+# seconds each point settles after it is set
+DWELL = 0.0
+
+
+class AsyncBNC845(object):
+    """
+    BNC845 signal generator over asyncio streams, see bncinst.BNC845. Every method
+    is a coroutine and times out (asyncio.TimeoutError) after timeout seconds.
+    Queries hold a lock from write to reply, so tasks may share one connection.
+    A timed out (or cancelled) message closes the connection, its late reply would
+    otherwise answer the next query, and the next message opens a new one
+
+    use connect() to create one
+
+    Parameters
+    ----------
+    reader, writer : asyncio.StreamReader, asyncio.StreamWriter
+        open connection to the instrument
+
+    address : tuple ('ip.address', port)
+        address of the instrument, for error messages
+
+    timeout : float, optional
+        seconds before a blocked read or write is abandoned
+
+    nodelay : bool, optional
+        disables Nagle's algorithm (TCP_NODELAY) on new connections
+
+    Returns
+    -------
+    AsyncBNC845 object
+    """
+    def __init__(self, reader, writer, address=DEFAULT_ADDRESS, timeout=TIMEOUT,
+                 nodelay=True):
+        self.addr = address
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.nodelay = nodelay
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, address=DEFAULT_ADDRESS, timeout=TIMEOUT, nodelay=True):
+        """ opens a connection to the instrument at address """
+        reader, writer = await _open(address, timeout, nodelay)
+        return cls(reader, writer, address, timeout, nodelay)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def _write(self, msg):
+        """ queues string msg, \n terminated if it isn't already """
+        if not msg.endswith('\n'):
+            msg += '\n'
+        self.writer.write(msg.encode())
+
+    async def _wait(self, awaitable):
+        """
+        awaits awaitable for at most timeout seconds. If it doesn't finish the
+        connection is out of step with the instrument and is closed
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.close()
+            raise
+
+    async def send(self, msg):
+        """ sends string msg as utf-8 encoded bytes to instrument """
+        if self.writer is None:
+            self.reader, self.writer = await _open(self.addr, self.timeout, self.nodelay)
+        self._write(msg)
+        await self._wait(self.writer.drain())
+
+    async def query(self, msg):
+        """ sends msg and returns its \n terminated reply """
+        async with self.lock:
+            with stagetimer.stage('query'):
+                await self.send(msg)
+                line = await self._wait(self.reader.readline())
+        if not line.endswith(b'\n'):
+            self.close()
+            raise socket.error("connection to {} closed".format(self.addr))
+        return line.decode('utf-8')
+
+    async def identify(self):
+        """ returns identification string of inst """
+        return await self.query('*IDN?')
+
+    async def set_freq(self, new_freq, check=True):
+        """
+        sets frequency to freq (MHZ), checked in the same message if check is True
+        Raise ValueSetException if frequency could not be set
+        """
+        assert new_freq is not None
+        msg = ':FREQ ' + str(new_freq) + 'MHZ'
+        if not check:
+            await self.send(msg)
+            return
+        BNC845._check('Frequency', await self.query(msg + ';:FREQ?'), new_freq, 1E-5, MHZ)
+
+    async def get_freq(self):
+        """ returns the frequency on the front panel of the instrument in MHZ """
+        return float(await self.query(':FREQ?'))
+
+    async def set_power(self, new_power, check=True):
+        """
+        sets power to power in dbm, checked in the same message if check is True
+        Raise ValueSetException if power could not be set
+        """
+        assert new_power is not None
+        msg = ':POW ' + str(new_power)
+        if not check:
+            await self.send(msg)
+            return
+        BNC845._check('Power', await self.query(msg + ';:POW?'), new_power, 1E-5, 1)
+
+    async def get_power(self):
+        """ returns the power on the front panel of the instrument in dbm """
+        return float(await self.query(':POW?'))
+
+    async def rf_on(self):
+        """ Tells instrument to turn on rf signal """
+        await self.send(':OUTP ON')
+
+    async def rf_off(self):
+        """ Tells instrument to turn off rf signal """
+        await self.send(':OUTP OFF')
+
+    def close(self):
+        """ closes the connection, the next message opens a new one """
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def _open(address, timeout, nodelay):
+    """ returns the (reader, writer) of a new connection to address """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(nodelay)))
+    return reader, writer
+
+
+class AsyncAnalyzer(object):
+    """
+    asyncio wrapper of a blocking (visa) spectrum analyzer: any method of inst is
+    available as a method returning an awaitable, run in a thread owned by this
+    instrument. Calls to one analyzer run one at a time in the order they were
+    made, calls to different analyzers run concurrently
+
+        spec = AsyncAnalyzer(HP8593E('GPIB0::18::INSTR'))
+        peak = await spec.get_peak()
+
+    Parameters
+    ----------
+    inst : SpectrumAnalyzer
+        analyzer to wrap, eg. specanalyzer.RandSFSP
+
+    Returns
+    -------
+    AsyncAnalyzer object
+    """
+    def __init__(self, inst):
+        self.inst = inst
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def call(self, method, *args, **kwargs):
+        """ returns a future of inst.method(*args, **kwargs) """
+        func = functools.partial(getattr(self.inst, method), *args, **kwargs)
+        return asyncio.get_event_loop().run_in_executor(self.executor, func)
+
+    def __getattr__(self, method):
+        if method.startswith('_') or not callable(getattr(self.inst, method)):
+            raise AttributeError(method)
+        return functools.partial(self.call, method)
+
+    def close(self):
+        """ waits for the calls in progress and stops the thread """
+        self.executor.shutdown()
+
+
+async def power_sweep(gen, out_powers, read, write=None, acquire=None, to_panel=None,
+                      settle=SETTLE, dwell=DWELL):
+    """
+    sets the power of gen to each power in out_powers in order and measures it,
+    overlapping what doesn't depend on the output power: once acquire() has
+    captured the analyzer's sweep of point k, read() fetches its value while the
+    generator moves on to point k+1, and results are written in a thread while
+    the sweep goes on. Without acquire, read() is awaited before the next set.
+    Returns [(power, value)] in the order of out_powers
+
+    Parameters
+    ----------
+    gen : AsyncBNC845
+        generator to sweep
+    out_powers : iterable
+        the output powers to use
+    read : coroutine function()
+        returns the measurement of the captured (or current) point
+    write : function(power, value), optional
+        blocking writer of each result, eg. to a file, called in order
+    acquire : coroutine function(), optional
+        captures the measurement of the current point, eg. AsyncAnalyzer.take_sweep
+    to_panel : function(power), optional
+        maps an output power to the panel power to set, eg. a gain file
+    settle : float, optional
+        seconds the output settles after rf is turned on
+    dwell : float, optional
+        seconds each point settles before it is acquired
+    """
+    out_powers = list(out_powers)
+    panels = [to_panel(power) if to_panel else power for power in out_powers]
+    loop = asyncio.get_event_loop()
+    writer = ThreadPoolExecutor(max_workers=1) if write else None
+    results = []
+    writes = []
+    pending = None
+
+    async def finish(power):
+        """ reads point power and queues its write """
+        with stagetimer.stage('read'):
+            value = await read()
+        results.append((power, value))
+        if writer:
+            writes.append(loop.run_in_executor(writer, write, power, value))
+
+    await gen.rf_off()
+    await gen.set_power(panels[0])
+    try:
+        await gen.rf_on()
+        with stagetimer.stage('settle'):
+            await asyncio.sleep(settle)
+        for power, panel in zip(out_powers, panels):
+            with stagetimer.stage('set'):
+                await gen.set_power(panel)
+            if dwell:
+                await asyncio.sleep(dwell)
+            if pending is not None:
+                # the analyzer has to be done with the previous point first
+                await pending
+                pending = None
+            if acquire is None:
+                await finish(power)
+                continue
+            with stagetimer.stage('acquire'):
+                await acquire()
+            pending = asyncio.ensure_future(finish(power))
+        if pending is not None:
+            await pending
+        await asyncio.gather(*writes)
+    except BaseException:
+        if pending is not None:
+            pending.cancel()
+        await gen.rf_off()
+        raise
+    finally:
+        if writer:
+            writer.shutdown(wait=False)
+
+    await gen.rf_off()
+    return results
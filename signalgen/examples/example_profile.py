@@ -1,4 +1,5 @@
 """ example program to create a gain file for a signal generator setup """
+import session
 from visainst import SpecAnalyzer
 from siggen import SignalGenerator
 
@@ -14,7 +15,7 @@ gen.freq(FREQ)
 
 # Setup spectrum analyzer
 SPEC_SPAN = 10. # initial span of spectrum analyzer window
-spec = SpecAnalyzer()
+spec = session.analyzer(SpecAnalyzer)
 spec.set_window(FREQ, SPEC_SPAN, GEN_MIN)
 spec.continuous_sweep()
 
@@ -1,4 +1,5 @@
 import numpy as np
+import session
 from visainst import SpecAnalyzer
 from siggen import SignalGenerator, sample_sweep_callback
 
@@ -10,7 +11,7 @@ GEN_MAX = 15
 ADDRESS = ('131.243.201.231', 18)
 
 # Setup spectrum analyzer
-spec = SpecAnalyzer()
+spec = session.analyzer(SpecAnalyzer)
 spec.set_window(FREQ, SPAN, GEN_MIN)
 spec.continuous_sweep()
 
@@ -4,6 +4,7 @@ import argparse
 
 import numpy as np
 from six.moves import input
+import session
 from siggen import SignalGenerator
 
 from adcutils import which_channel, gen_filename, adc_vals
@@ -41,7 +42,7 @@ def output_callback(power_in, state):
 
 def profile(gen, filename):
     from visainst import SpecAnalyzer
-    spec = SpecAnalyzer()
+    spec = session.analyzer(SpecAnalyzer)
     spec.set_window(FREQ, 10, gen.min_output)
     spec.continuous_sweep()
 
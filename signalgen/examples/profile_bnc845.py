@@ -1,4 +1,5 @@
 """ example program to create a gain file for a signal generator setup """
+import session
 from specanalyzer import EnetRandSFSP
 from siggen import SignalGenerator
 
@@ -14,7 +15,7 @@ SPEC_ADDR = '131.243.171.57'
 
 
 # Setup spectrum analyzer
-spec = EnetRandSFSP(SPEC_ADDR, 18)
+spec = session.analyzer(EnetRandSFSP, SPEC_ADDR, 18)
 
 spec.reset() # not necessary if window manually set up
 spec.disp_on(False)
@@ -0,0 +1,54 @@
+"""
+persistent instrument sessions: one connection per instrument address, shared by
+everything in the process which asks for it instead of a new connection each time
+
+    gen = SignalGenerator(ADDRESS)                  # connects to the BNC845
+    gen2 = SignalGenerator(ADDRESS, gain_file='g')  # shares the same connection
+    spec = session.analyzer(SpecAnalyzer)           # opened once, shared after
+
+the BNC845 reconnects by itself when its socket dies and restores its frequency,
+power and rf state (see bncinst.BNC845.reconnect), so a dropped connection
+doesn't abort a long sweep. visa analyzers share one resource manager, opened on
+first use instead of at import
+"""
+import atexit
+
+from bncinst import BNC845, DEFAULT_ADDRESS, TIMEOUT
+
+_SESSIONS = {}
+_RM = {}
+
+
+def bnc845(address=DEFAULT_ADDRESS, timeout=TIMEOUT):
+    """ returns the shared BNC845 at address with timeout, connecting on first use """
+    key = (BNC845, tuple(address), timeout)
+    if key not in _SESSIONS:
+        _SESSIONS[key] = BNC845(tuple(address), timeout)
+    return _SESSIONS[key]
+
+
+def analyzer(cls, *args):
+    """ returns the shared cls(*args) (eg. a spectrum analyzer), created on first use """
+    key = (cls,) + args
+    if key not in _SESSIONS:
+        _SESSIONS[key] = cls(*args)
+    return _SESSIONS[key]
+
+
+def resource_manager():
+    """ returns the visa resource manager shared by every visa instrument """
+    if 'rm' not in _RM:
+        import visa
+        _RM['rm'] = visa.ResourceManager()
+    return _RM['rm']
+
+
+def close_all():
+    """ closes and forgets every shared instrument """
+    for inst in _SESSIONS.values():
+        if hasattr(inst, 'close'):
+            inst.close()
+    _SESSIONS.clear()
+
+
+atexit.register(close_all)
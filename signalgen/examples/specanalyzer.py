@@ -1,8 +1,8 @@
 from __future__ import print_function
-import visa
+from pyvisa.constants import VI_ERROR_CONN_LOST
 from pyvisa.errors import VisaIOError
 
-RM = visa.ResourceManager()
+import session
 
 DEFAULT_CHANNEL = 16
 # DEFAULT_ADDR = "TCPIP::131.243.171.57::1234::SOCKET"
@@ -13,19 +13,56 @@ def gpib_addr_str(gpib_address):
     return 'GPIB0::' + str(gpib_address) + '::INSTR'
 
 class SpectrumAnalyzer(object):
-    """ low level wrapper for visa controlled spectrum analyzers """
-    def __init__(self, addr):
+    """
+    low level wrapper for visa controlled spectrum analyzers
+    resources are opened through the shared resource manager (see session) and
+    reopened once, with setup() run again, if a message finds the connection lost
+    """
+    def __init__(self, addr, **kwargs):
         self.addr = addr
-        self.inst = RM.open_resource(addr)
+        self.open_kwargs = kwargs
+        self.inst = None
+        self.open()
+
+    def open(self):
+        """ opens the visa resource and sets it up """
+        self.inst = session.resource_manager().open_resource(self.addr, **self.open_kwargs)
+        self.setup()
+
+    def setup(self):
+        """ configures a newly opened resource """
+        pass
+
+    def reopen(self):
+        """ closes the visa resource and opens it again """
+        try:
+            self.inst.close()
+        except VisaIOError:
+            pass
+        self.open()
+
+    def close(self):
+        """ closes the visa resource """
+        self.inst.close()
+
+    def _retry(self, method, *args, **kwargs):
+        """ calls inst.method, once more after reopen if the connection was lost """
+        try:
+            return getattr(self.inst, method)(*args, **kwargs)
+        except VisaIOError as err:
+            if err.error_code != VI_ERROR_CONN_LOST:
+                raise
+        self.reopen()
+        return getattr(self.inst, method)(*args, **kwargs)
 
     def write(self, message):
-        self.inst.write(message)
+        self._retry('write', message)
 
     def read(self):
-        return self.inst.read()
+        return self._retry('read')
 
     def query(self, message, delay=None):
-        return self.inst.query(message, delay=delay)
+        return self._retry('query', message, delay=delay)
 
 class RandSFSP(SpectrumAnalyzer):
     """
@@ -46,6 +83,9 @@ class RandSFSP(SpectrumAnalyzer):
     """
     def __init__(self, addr):
         super(RandSFSP, self).__init__(addr)
+
+    def setup(self):
+        """ sets read termination and timeout """
         self.inst.read_termination='\n'
         self.inst.timeout=15000
 
@@ -143,24 +183,23 @@ class EnetRandSFSP(RandSFSP):
     RandSFSP spectrum analyzer object
     """
     def __init__(self, ip_addr, gpib_addr):
+        self.gpib_addr = gpib_addr
         super(EnetRandSFSP, self).__init__("TCPIP::" + ip_addr +"::1234::SOCKET")
-        self.write("++mode 1\n++auto 1\n++addr {0:d}".format(gpib_addr))
+
+    def setup(self):
+        """ sets up the resource and points the controller at the instrument """
+        super(EnetRandSFSP, self).setup()
+        self.inst.write("++mode 1\n++auto 1\n++addr {0:d}".format(self.gpib_addr))
 
 class HP8593E(SpectrumAnalyzer):
     """ wrapper for HP8593H visa library control """
     def __init__(self, addr):
         super(HP8593E, self).__init__(addr, read_termination='\n')
         
-    def write(self, msg):
-        self.inst.write(msg)
-
-    def read(self):
-        return self.inst.read()
-
     def query(self, msg, fix_skipping=False):
-        ret_msg = self.inst.query(msg)
+        ret_msg = self._retry('query', msg)
         while fix_skipping and not ret_msg:
-            ret_msg = self.inst.query(msg)
+            ret_msg = self._retry('query', msg)
         return ret_msg
 
     def single_sweep(self):
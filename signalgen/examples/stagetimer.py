@@ -0,0 +1,171 @@
+"""
+named stage timers for profiling without an external profiler
+
+timing is off unless enable() is called or the APEX_PROFILE environment variable
+is set when this module is imported. APEX_PROFILE=1 prints a report of wall time
+and call count per stage at exit, any other value is a file name to write the
+report to as json. While disabled, stage() returns a shared do nothing context
+manager and timed functions make a single extra check, so instrumentation can
+stay in place
+
+    with stagetimer.stage('parse'):
+        ...
+
+    @stagetimer.timed('reduce')
+    def xyreduce(...):
+
+stages may nest, a stage's time excludes the stages inside it, so the times of
+all stages add up to the time spent in them. Stages of concurrent tasks (asyncio)
+which happen to overlap are counted in whichever stage was entered first. Only
+the process calling enable() reports, pool workers should send stats() back to
+be merge()d
+
+plot_tools/stagetimer.py is the master copy of this module. signalgen/ and
+signalgen/examples/ run on their own and hold identical copies: edit the master,
+then copy it over them (plot_tools/test_stagetimer.py checks they match)
+"""
+from __future__ import print_function
+import atexit
+import functools
+import json
+import os
+import sys
+from timeit import default_timer as timer
+
+ENV = 'APEX_PROFILE'
+
+_STATS = {}
+_STATE = {'enabled': False, 'output': None, 'registered': False}
+# open stages, innermost last
+_OPEN = []
+
+
+class _NullStage(object):
+    """ context manager which does nothing, used while timing is disabled """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Stage(object):
+    """
+    context manager adding its wall time, less that of the stages inside it, to
+    the stats of name
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.inner = 0.0
+        self.parent = None
+
+    def __enter__(self):
+        self.parent = _OPEN[-1] if _OPEN else None
+        _OPEN.append(self)
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = timer() - self.start
+        _OPEN.remove(self)
+        if self.parent is not None and self.parent in _OPEN:
+            self.parent.inner += elapsed
+        stats = _STATS.setdefault(self.name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed - self.inner
+        return False
+
+
+_NULL = _NullStage()
+
+
+def enabled():
+    """ returns True if stages are being timed """
+    return _STATE['enabled']
+
+
+def enable(output=None):
+    """
+    starts timing stages and reports them at exit, printed to stderr if output is
+    None or written as json to the file output
+    """
+    _STATE['enabled'] = True
+    _STATE['output'] = output
+    if not _STATE['registered']:
+        atexit.register(_report_at_exit)
+        _STATE['registered'] = True
+
+
+def disable():
+    """ stops timing stages, the stats so far are kept """
+    _STATE['enabled'] = False
+
+
+def reset():
+    """ forgets all stats """
+    _STATS.clear()
+
+
+def stage(name):
+    """ returns a context manager timing its body as stage name """
+    if not _STATE['enabled']:
+        return _NULL
+    return _Stage(name)
+
+
+def timed(name):
+    """ decorator timing every call of the function as stage name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stats():
+    """ returns {stage: {'calls': n, 'seconds': wall time less nested stages}} """
+    return dict((name, {'calls': calls, 'seconds': seconds})
+                for name, (calls, seconds) in _STATS.items())
+
+
+def merge(other):
+    """ adds other, a stats() dict (eg. from a pool worker), to the stats """
+    for name, stats in other.items():
+        totals = _STATS.setdefault(name, [0, 0.0])
+        totals[0] += stats['calls']
+        totals[1] += stats['seconds']
+
+
+def report(out=None):
+    """ prints a table of the stages, slowest first, to out (stderr by default) """
+    out = out or sys.stderr
+    print("{:>20} {:>8} {:>12} {:>12}".format('stage', 'calls', 'total (s)', 'mean (ms)'),
+          file=out)
+    for name, (calls, seconds) in sorted(_STATS.items(), key=lambda item: -item[1][1]):
+        print("{:>20} {:>8d} {:>12.3f} {:>12.3f}".format(
+            name, calls, seconds, 1e3 * seconds / calls), file=out)
+
+
+def write_json(filename):
+    """ writes stats() to filename as json """
+    with open(filename, 'w') as filep:
+        json.dump(stats(), filep, indent=2, sort_keys=True)
+
+
+def _report_at_exit():
+    """ atexit hook reporting the stats if anything was timed """
+    if not _STATS:
+        return
+    if _STATE['output']:
+        write_json(_STATE['output'])
+    else:
+        report()
+
+
+if os.environ.get(ENV):
+    enable(None if os.environ[ENV] == '1' else os.environ[ENV])
@@ -1,4 +1,4 @@
-import visa
+import session
 
 DEFAULT_CHANNEL = 16
 
@@ -10,9 +10,12 @@ class SpecAnalyzer(object):
     def __init__(self, channel_no=DEFAULT_CHANNEL):
         self.inst_name = gpib_name(channel_no)
         # TODO: check for inst
-        rm = visa.ResourceManager()
+        rm = session.resource_manager()
         self.inst = rm.open_resource(self.inst_name, read_termination='\n')
 
+    def close(self):
+        self.inst.close()
+
     def write(self, msg):
         self.inst.write(msg)
 
@@ -1,15 +1,19 @@
 """ contains a generic signal generator class """
 
 from __future__ import print_function
+import socket
 from time import sleep
 import numpy as np
 from scipy.interpolate import interp1d
 
-from bncinst import BNC845
+import session
+import stagetimer
 
 DEFAULT_MIN = -30.0
 DEFAULT_MAX = 15.0
 DEFAULT_ADDRESS = ('131.243.201.231', 18)
+# seconds each point of a hardware list sweep is held before it is measured
+LIST_DWELL = 0.05
 
 class SignalGenerator(object):
     """
@@ -25,6 +29,8 @@ class SignalGenerator(object):
 
     TODO: make signal generator generic. Currently only works with BNC845 class.
 
+    instances with the same addr share one connection to the instrument, see session
+
     Parameters
     ----------
     addr : tuple ('ip.address', port), optional
@@ -46,8 +52,8 @@ class SignalGenerator(object):
     SignalGenerator object
     """
     def __init__(self, addr=DEFAULT_ADDRESS, min_output=None, max_output=None, gain_file=None):
-        # initialize signal generator
-        self.gen = BNC845(addr)
+        # initialize signal generator, shared with others at addr
+        self.gen = session.bnc845(addr)
         self.gain_file = gain_file
 
         if self.gain_file:
@@ -80,7 +86,8 @@ class SignalGenerator(object):
             new_power = self.real_to_panel(new_power)
         return self.gen.power(new_power)
 
-    def power_sweep(self, out_powers, callback, state=None):
+    def power_sweep(self, out_powers, callback, state=None, defer_verify=False,
+                    hardware=False, dwell=LIST_DWELL):
         """
         sets the power to each power in out_powers in order calling callback with each set power
 
@@ -92,20 +99,84 @@ class SignalGenerator(object):
             called on each set power with power and state as arguments
         state :
             passed to callback on each set power
+        defer_verify : bool, optional
+            if True each set is sent without waiting for its read back, and every
+            point is verified in one batch once the sweep is done. Faster, but a
+            power which couldn't be set is only reported (ValueSetException) after
+            the whole sweep has run
+        hardware : bool, optional
+            if True the whole (panel) power list is uploaded to the instrument once
+            and each point is reached with a trigger instead of a set (see list_sweep)
+        dwell : float, optional
+            seconds a hardware sweep point settles before callback is called
         """
+        if hardware:
+            self.list_sweep(out_powers, callback, state, dwell)
+            return
+
         self.rf_off()
         self.power(out_powers[0])
         try:
             self.rf_on()
-            sleep(1)
+            with stagetimer.stage('settle'):
+                sleep(1)
+            for power in out_powers:
+                with stagetimer.stage('set'):
+                    if defer_verify:
+                        panel = self.real_to_panel(power) if self.gain_file else power
+                        self.gen.set_power(panel, defer=True)
+                    else:
+                        self.power(power)
+                with stagetimer.stage('measure'):
+                    callback(power, state)
+            if defer_verify:
+                self.gen.verify_deferred()
+        except:
+            # rf off first, reading the deferred replies fails if the connection is gone
+            try:
+                self.rf_off()
+            finally:
+                try:
+                    self.gen.discard_deferred()
+                except socket.error:
+                    pass
+            raise
+
+        self.rf_off()
+
+    def list_sweep(self, out_powers, callback, state=None, dwell=LIST_DWELL):
+        """
+        power_sweep run by the instrument's list sweep: out_powers (mapped to panel
+        powers if there is a gain file) are uploaded and verified once, then every
+        point is a single trigger message followed by dwell seconds for the output
+        to settle before callback(power, state). No round trip to the instrument is
+        waited on between points
+        """
+        if self.gain_file:
+            panels = [self.real_to_panel(power) for power in out_powers]
+        else:
+            panels = list(out_powers)
+        self.rf_off()
+        self.gen.upload_power_list(panels)
+        try:
+            self.gen.start_list()
+            self.rf_on()
+            with stagetimer.stage('settle'):
+                sleep(1)
             for power in out_powers:
-                self.power(power)
-                callback(power, state)
+                with stagetimer.stage('set'):
+                    self.gen.trigger()
+                with stagetimer.stage('settle'):
+                    sleep(dwell)
+                with stagetimer.stage('measure'):
+                    callback(power, state)
         except:
             self.rf_off()
+            self.gen.stop_list()
             raise
 
         self.rf_off()
+        self.gen.stop_list()
 
     def rf_on(self):
         """ turns rf signal on (begins signal output) """